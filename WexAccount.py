@@ -1,12 +1,17 @@
 #!/usr/bin/env python3
 import boto3
+import gzip
 import json
 import os
 import re
 import tempfile
+import threading
 import logging
 
 from argparse import Namespace
+from collections.abc import Mapping
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from time import time
 
 system_cleanup = set([
         'ResponseMetadata',
@@ -143,6 +148,66 @@ aws_region_limit = set([
     'ap-southeast-2',
     ])
 
+# items fetched once per object of another item:
+# name -> (source item, object id key, request parameter, id as a list)
+aws_per_object = {
+        'vpc-association-authorizations': (
+            'hosted-zones', 'Id', 'HostedZoneId', False),
+        'hosted-zone-associations': (
+            'hosted-zones', 'Id', 'Id', False),
+        'resolver-endpoint-ip-addresses': (
+            'resolver-endpoints', 'Id', 'ResolverEndpointId', False),
+        'security-group-references': (
+            'security-groups', 'GroupId', 'GroupId', True),
+        }
+
+# crawl threads, and API calls in flight per service (Route 53 allows
+# 5 requests per second for the whole account)
+crawl_workers = 16
+crawl_service_limits = {
+        'ec2': 8,
+        'route53': 2,
+        'route53resolver': 4,
+        }
+
+# inventory cache per (item, region): format version, gzip level, default
+# time to live (seconds) and the items changing less often
+cache_version = 1
+cache_compresslevel = 6
+cache_ttl = 12 * 3600
+cache_item_ttl = {
+        'regions': 7 * 86400,
+        'availability-zones': 7 * 86400,
+        'prefix-lists': 86400,
+        }
+
+
+class LazyInventory(Mapping):
+    '''
+    Read-only view of the account inventory; an item (and the items it
+    depends on) is retrieved the first time it is accessed
+    '''
+    def __init__(self, account):
+        self.account = account
+
+    def __getitem__(self, name):
+        if name not in aws:
+            raise KeyError(name)
+
+        if name not in self.account.loaded:
+            self.account.retrieve_all([name])
+
+        return self.account.inventory[name]
+
+    def __contains__(self, name):
+        return name in aws  # don't fetch on membership tests
+
+    def __iter__(self):
+        return iter(aws)
+
+    def __len__(self):
+        return len(aws)
+
 
 class WexAccount:
     def __init__(self, args, profile):
@@ -159,31 +224,80 @@ class WexAccount:
         self.logger.addHandler(ch)
 
         self.profile = profile
-        self.data = dict([
+        self.inventory = dict([
             [name, dict()]
             for name
             in aws.keys()
             ])
-        self.retrieve_all()
+        self.loaded = set()  # items retrieved into self.inventory
+        self.retrieve_lock = threading.Lock()
+        self.data = LazyInventory(self)
+
+        # clients are thread safe, sessions are not: build under the lock
+        self.clients = dict()
+        self.clients_lock = threading.Lock()
+        self.service_slots = dict([
+            [service, threading.BoundedSemaphore(limit)]
+            for service, limit
+            in crawl_service_limits.items()
+            ])
 
-    def cache_data(self, key, value=None):
-        tempdir = (f'{tempfile.gettempdir()}/{self.profile}')
+    def cache_path(self, name, region=None):
+        return (f'{tempfile.gettempdir()}/{self.profile}/{name}/'
+                f'{region or "global"}.json.gz')
 
-        if not os.path.isdir(f'{tempdir}'):
-            os.mkdir(f'{tempdir}')
+    def cache_data(self, name, region=None, value=None):
+        '''
+        Cached inventory of one (item, region) under `/tmp/{profile}`;
+        returns None when missing, expired, corrupt or of another version
+        '''
+        path = self.cache_path(name, region)
 
         if value is not None:
-            with open(f'{tempdir}/{key}.json', 'w') as f:
-                json.dump(value, f)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+            blob = gzip.compress(json.dumps({
+                'Version': cache_version,
+                'Created': time(),
+                'Data': value,
+                }, default=str).encode(), compresslevel=cache_compresslevel)
+
+            # rename over the old file; readers never see a partial write
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path),
+                                       suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(blob)
+                os.replace(tmp, path)
+            except BaseException:
+                os.unlink(tmp)
+                raise
             return
 
         try:
-            with open(f'{tempdir}/{key}.json') as f:
-                value = json.load(f)
+            with open(path, 'rb') as f:
+                entry = json.loads(gzip.decompress(f.read()))
         except FileNotFoundError:
-            pass
-
-        return value
+            return None
+        except (OSError, EOFError, ValueError) as e:
+            self.logger.warning(f'Ignoring cache {path}: {e}')
+            return None
+
+        if entry.get('Version') != cache_version:
+            return None
+        if time() - entry.get('Created', 0) > \
+                cache_item_ttl.get(name, cache_ttl):
+            return None
+
+        return entry['Data']
+
+    def aws_client(self, service, region):
+        with self.clients_lock:
+            if (service, region) not in self.clients:
+                session = boto3.Session(profile_name=self.profile,
+                                        region_name=region)
+                self.clients[(service, region)] = session.client(service)
+            return self.clients[(service, region)]
 
     def aws_items(self, args):
         value = list()
@@ -192,12 +306,15 @@ class WexAccount:
 
         item, region = args.pop('Item'), args.pop('Region')
 
-        session = boto3.Session(profile_name=self.profile, region_name=region)
-        client = session.client(aws[item]['service'])
+        service = aws[item]['service']
+        client = self.aws_client(service, region)
+        slot = self.service_slots.setdefault(
+                service, threading.BoundedSemaphore(crawl_workers))
 
         try:
             while True:
-                page = getattr(client, aws[item]['command'])(**args)
+                with slot:
+                    page = getattr(client, aws[item]['command'])(**args)
                 keys = page.keys() - system_cleanup
 
                 # if extra cleanup is required - do it now
@@ -264,102 +381,198 @@ class WexAccount:
 
         return worldwide + regional
 
-    def retrieve_all(self):
+    def item_closure(self, names):
+        '''
+        Returns the names with everything they depend on
+        '''
+        closure, pending = set(), list(names)
+
+        while pending:
+            name = pending.pop()
+            if name in closure:
+                continue
+            closure.add(name)
+
+            pending += list(aws[name].get('dep', dict()))
+            if 'global' not in aws[name]:
+                pending.append('regions')  # regions to collect
+
+        return closure
+
+    def crawl_units(self, names=None):
+        '''
+        Task DAG: (name, region) -> the (name, region) units it waits for;
+        region is None for global items
+        '''
+        units = dict()
+
+        closure = self.item_closure(names if names is not None else aws)
         for name in self.resolve_dependencies():
+            if name not in closure:
+                continue
 
-            # check if we have cached data stored under `/tmp/{profile}`
-            cached = self.cache_data(name)
-            if cached is not None:
-                self.data[name] = cached
-                continue  # data is loaded from cache; don't reload
-
-            self.logger.info(f'Retrieving {self.profile}:{name}')
-            if 'global' in aws[name]:
-                if name in [
-                        'vpc-association-authorizations',
-                        'hosted-zone-associations',
-                        ]:
-                    zones = [
-                            re.sub('.*/', '', zone['Id'])
-                            for zone in self.data['hosted-zones']
-                            if zone['Config']['PrivateZone']
-                            ]
-
-                    for zone in zones:
-                        args = {
-                                'Item': name,
-                                'Region': 'us-east-1',
-                                }
-
-                        if name == 'vpc-association-authorizations':
-                            args['HostedZoneId'] = zone
-                        elif name == 'hosted-zone-associations':
-                            args['Id'] = zone
-                        else:
-                            raise ValueError(f'{name} should not be here')
-
-                        self.data[name][zone] = self.aws_items(args)
-                else:
-                    args = {
-                            'Item': name,
-                            'Region': 'us-east-1',
-                            }
-                    self.data[name] = self.aws_items(args)
-            else:
-                # collect data for all regions (minus unsupported)
-                regions = set([
+            regions = [None]
+            if 'global' not in aws[name]:
+                regions = sorted(aws_region_limit)
+
+            for region in regions:
+                deps = set()
+                if region is not None:
+                    deps.add(('regions', None))  # regions to collect
+                for dep in aws[name].get('dep', dict()):
+                    deps.add((dep, None if 'global' in aws[dep] else region))
+
+                units[(name, region)] = deps
+
+        return units
+
+    def unit_requests(self, name, region):
+        '''
+        Returns [(object id or None, aws_items args), ..], None when the
+        region is not collected; the inputs are ready
+        '''
+        if region is not None:
+            # collect data for all regions (minus unsupported)
+            if region in aws[name].get('skip-regions', list()) or \
+                    region not in [
                         region['RegionName']
                         for region
-                        in self.data['regions']
-                        if 'skip-regions'
-                        not in aws[name]
-                        or region['RegionName']
-                        not in aws[name]['skip-regions']
-                        ])
-
-                for region in aws_region_limit.intersection(regions):
-                    # TODO avoid copy/paste, make it a table lookup
-                    if name in [
-                            'resolver-endpoint-ip-addresses',
-                            ]:
-                        self.data[name][region] = dict()
-                        for id in [
-                                id['Id']
-                                for id
-                                in self.data['resolver-endpoints'][region]
-                                ]:
-                            args = {
-                                    'Item': name,
-                                    'Region': region,
-                                    'ResolverEndpointId': id,
-                                    }
-                            self.data[name][region][id] = self.aws_items(args)
-                    elif name in [
-                            'security-group-references',
-                            ]:
-                        self.data[name][region] = dict()
-                        for id in [
-                                id['GroupId']
-                                for id
-                                in self.data['security-groups'][region]
-                                ]:
-                            args = {
-                                    'Item': name,
-                                    'Region': region,
-                                    'GroupId': [id],
-                                    }
-                            self.data[name][region][id] = self.aws_items(args)
-                    else:
-                        args = {
-                                'Item': name,
-                                'Region': region,
-                                }
-                        self.data[name][region] = self.aws_items(args)
-
-            self.cache_data(name, self.data[name])
+                        in self.inventory['regions']
+                        ]:
+                return None
+
+        args = {
+                'Item': name,
+                'Region': region if region is not None else 'us-east-1',
+                }
+
+        if name not in aws_per_object:
+            return [(None, args)]
+
+        src, key, parameter, as_list = aws_per_object[name]
+
+        objects = self.inventory[src]
+        if region is not None:
+            objects = objects[region]
+        if src == 'hosted-zones':
+            objects = [
+                    dict(zone, Id=re.sub('.*/', '', zone['Id']))
+                    for zone in objects
+                    if zone['Config']['PrivateZone']
+                    ]
+
+        return [
+                (
+                    obj[key],
+                    dict(args, **{
+                        parameter: [obj[key]] if as_list else obj[key],
+                        }),
+                    )
+                for obj
+                in objects
+                ]
+
+    def store_unit(self, name, region, id, value):
+        dst = self.inventory[name]
+        if region is not None and id is not None:
+            dst = dst.setdefault(region, dict())
+        elif region is None and id is None:
+            self.inventory[name] = value
+            return
+
+        dst[region if id is None else id] = value
+
+    def retrieve_all(self, names=None):
+        '''
+        Runs the (name, region, id) fetches of the names (default: all) and
+        their dependencies on a bounded pool; a unit starts as soon as the
+        units it depends on are done
+        '''
+        with self.retrieve_lock:
+            self.crawl(self.crawl_units(names))
 
         return self
 
+    def crawl(self, units):
+        done, started = set([
+            unit
+            for unit
+            in units
+            if unit[0] in self.loaded
+            ]), set()
+
+        # check if we have cached data stored under `/tmp/{profile}`; stale
+        # (item, region) units are fetched again, fresh ones are kept
+        for unit in units:
+            if unit in done:
+                continue
+            cached = self.cache_data(*unit)
+            if cached is not None:
+                self.store_unit(*unit, None, cached)
+                done.add(unit)
+        started.update(done)
+
+        outstanding = dict()  # unit -> number of requests not done yet
+        futures = dict()  # future -> (unit, object id)
+
+        def finish(unit):
+            done.add(unit)
+
+            name, region = unit
+            value = self.inventory[name]
+            if region is not None:
+                value = value.get(region)  # None when not collected
+
+            if value is not None:
+                self.cache_data(name, region, value)
+
+        def start_ready(executor):
+            for unit, deps in units.items():
+                if unit in started or not deps <= done:
+                    continue
+                started.add(unit)
+
+                name, region = unit
+                self.logger.info(f'Retrieving {self.profile}:{name}'
+                                 f' {region or ""}')
+
+                requests = self.unit_requests(name, region)
+                if requests is None:
+                    requests = list()
+                elif name in aws_per_object and region is not None:
+                    self.inventory[name][region] = dict()
+
+                outstanding[unit] = len(requests)
+                for id, args in requests:
+                    futures[executor.submit(self.aws_items, args)] = \
+                        (unit, id)
+
+                if not requests:
+                    finish(unit)
+
+        with ThreadPoolExecutor(max_workers=crawl_workers) as executor:
+            try:
+                start_ready(executor)
+
+                while futures:
+                    ready, _ = wait(futures, return_when=FIRST_COMPLETED)
+
+                    for future in ready:
+                        unit, id = futures.pop(future)
+                        self.store_unit(*unit, id, future.result())
+
+                        outstanding[unit] -= 1
+                        if not outstanding[unit]:
+                            finish(unit)
+
+                    start_ready(executor)
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+
+        self.loaded.update([name for name, region in units])
+
     def retrieve_object(self, args):
         '''
         args = {
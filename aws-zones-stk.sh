@@ -37,6 +37,41 @@ cat > "$fragment" <<EOF
       "Type": "Number",
       "Description": "Limit RuleId count per RAM Share",
       "Default": "50"
+    },
+    "MaxParallelLanes": {
+      "Type": "Number",
+      "Description": "Independent chains of RAM Shares and associations",
+      "Default": "4",
+      "MinValue": "1"
+    },
+    "ForceRefresh": {
+      "Type": "String",
+      "Description": "Change to re-run all cross-account auto-associations",
+      "Default": ""
+    },
+    "AutoAssociateScope": {
+      "Type": "String",
+      "Description": "Custom resource per Principal, or per Share",
+      "Default": "Principal",
+      "AllowedValues": ["Principal", "Share"]
+    },
+    "StackLevelTags": {
+      "Type": "String",
+      "Description": "Common tags come from the stack tags only",
+      "Default": "false",
+      "AllowedValues": ["true", "false"]
+    },
+    "ShardCount": {
+      "Type": "Number",
+      "Description": "Zones are split into this many stacks",
+      "Default": "1",
+      "MinValue": "1"
+    },
+    "ShardIndex": {
+      "Type": "Number",
+      "Description": "Shard of the zones handled by this stack",
+      "Default": "0",
+      "MinValue": "0"
     }
   },
   "Transform": [
@@ -54,30 +89,46 @@ jq ".Mappings.Wex.Infoblox.Regions |=
     $(jq .VpcDni "$static_parameters")" \
         "$combined" > "$json"
 
-aws --profile "wex-$profile" --region "$region" \
-    cloudformation "$(create_or_update "$stack_name")-stack" \
-    --stack-name "$stack_name" --template-body "file://$json" \
-    --tags "$(retrieve_tags)" \
-    --capabilities CAPABILITY_AUTO_EXPAND \
-    --parameters "[
-        {
-            \"ParameterKey\": \"CrossAccountRoleName\",
-            \"ParameterValue\": \"$role_satellite\"
-        },
-        {
-            \"ParameterKey\": \"Lob\",
-            \"ParameterValue\": \"$wex_lob\"
-        },
-        {
-            \"ParameterKey\": \"Environment\",
-            \"ParameterValue\": \"$wex_environment\"
-        },
-        {
-            \"ParameterKey\": \"TargetEnvironment\",
-            \"ParameterValue\": \"$target_environment\"
-        },
-        {
-            \"ParameterKey\": \"Instantiate\",
-            \"ParameterValue\": \"$kind\"
-        }
-    ]"
+# one stack per shard; CloudFormation deploys them in parallel
+for (( shard = 0; shard < shards; shard++ )); do
+    shard_stack_name=$stack_name
+    if (( shards > 1 )); then
+        shard_stack_name="${stack_name%-stk}-s$(printf '%02d' "$shard")-stk"
+    fi
+
+    aws --profile "wex-$profile" --region "$region" \
+        cloudformation "$(create_or_update "$shard_stack_name")-stack" \
+        --stack-name "$shard_stack_name" --template-body "file://$json" \
+        --tags "$(retrieve_tags)" \
+        --capabilities CAPABILITY_AUTO_EXPAND \
+        --parameters "[
+            {
+                \"ParameterKey\": \"CrossAccountRoleName\",
+                \"ParameterValue\": \"$role_satellite\"
+            },
+            {
+                \"ParameterKey\": \"Lob\",
+                \"ParameterValue\": \"$wex_lob\"
+            },
+            {
+                \"ParameterKey\": \"Environment\",
+                \"ParameterValue\": \"$wex_environment\"
+            },
+            {
+                \"ParameterKey\": \"TargetEnvironment\",
+                \"ParameterValue\": \"$target_environment\"
+            },
+            {
+                \"ParameterKey\": \"Instantiate\",
+                \"ParameterValue\": \"$kind\"
+            },
+            {
+                \"ParameterKey\": \"ShardCount\",
+                \"ParameterValue\": \"$shards\"
+            },
+            {
+                \"ParameterKey\": \"ShardIndex\",
+                \"ParameterValue\": \"$shard\"
+            }
+        ]"
+done
@@ -218,6 +218,54 @@ EOF
     jq -n 'reduce inputs as $i ({}; . * $i)' "$json" "$fragment" > "$combined"
     mv "$combined" "$json"
 
+    # Checkpoint table shared by all the containers of CFNAutoAssociate
+    if [[ $function = 'CFNAutoAssociate' ]]; then
+        cat > "$fragment" <<EOF
+{
+  "Resources": {
+    "${function}Checkpoints": {
+      "Type": "AWS::DynamoDB::Table",
+      "Properties": {
+        "TableName": "${function}Checkpoints",
+        "BillingMode": "PAY_PER_REQUEST",
+        "AttributeDefinitions": [
+          {
+            "AttributeName": "Id",
+            "AttributeType": "S"
+          }
+        ],
+        "KeySchema": [
+          {
+            "AttributeName": "Id",
+            "KeyType": "HASH"
+          }
+        ],
+        "TimeToLiveSpecification": {
+          "AttributeName": "ExpiresAt",
+          "Enabled": true
+        },
+        "Tags": $(retrieve_tags)
+      }
+    },
+    "$function": {
+      "Properties": {
+        "Environment": {
+          "Variables": {
+            "CHECKPOINT_TABLE": {
+              "Ref": "${function}Checkpoints"
+            }
+          }
+        }
+      }
+    }
+  }
+}
+EOF
+        jq -n 'reduce inputs as $i ({}; . * $i)' "$json" "$fragment" \
+            > "$combined"
+        mv "$combined" "$json"
+    fi
+
     # Export Function name
     cat > "$fragment" <<EOF
 {
@@ -1,62 +1,469 @@
 #!/usr/bin/python3
-import boto3
+import json
 import logging
+import os
 import re
+import threading
+
+from functools import partial
+from time import monotonic, sleep, time
 
 import utilities
 
 logger = logging.getLogger()
 logger.setLevel(logging.DEBUG)
 
+# worker pool for associate/disassociate calls, and the calls in flight
+# per account (API limits are per account, shared by all the workers)
+association_workers = 16
+max_account_calls = 8
+
+account_slots = dict()
+account_slots_lock = threading.Lock()
+
+# failed pairs listed in the summary error (CFN truncates the reason)
+max_reported_failures = 10
+
+# shared rules show up in the principal account with a delay; poll the
+# listing from `readiness_delay` seconds, doubling up to `max_delay`
+readiness_deadline = 120
+readiness_delay = 1.0
+readiness_max_delay = 16.0
+
+# long syncs stop `deadline_margin` seconds before the Lambda timeout,
+# save their progress and continue in a new (asynchronous) invocation
+deadline_margin = 30
+max_invocations = 20
+
+# progress store: DynamoDB table (string key `Id`) if set, else files
+checkpoint_table = os.environ.get('CHECKPOINT_TABLE')
+checkpoint_dir = os.environ.get('CHECKPOINT_DIR', '/tmp/checkpoints')
+checkpoint_ttl = 24 * 60 * 60
+
+
+class FileCheckpoints:
+    '''
+    Checkpoints as JSON files; only shared by invocations landing in the
+    same container, progress is re-listed from the API otherwise
+    '''
+    def __init__(self, directory=checkpoint_dir):
+        self.directory = directory
+
+    def path(self, key):
+        return os.path.join(self.directory, f'{key}.json')
+
+    def load(self, key):
+        try:
+            with open(self.path(key)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def save(self, key, state):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(f'{self.path(key)}.tmp', 'w') as f:
+            json.dump(state, f)
+        os.replace(f'{self.path(key)}.tmp', self.path(key))
+
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+
+class DynamoDBCheckpoints:
+    '''
+    Checkpoints as DynamoDB items, expired by the table TTL (`ExpiresAt`)
+    '''
+    def __init__(self, table=checkpoint_table):
+        self.table = table
+
+    def load(self, key):
+        item = utilities.boto3_client('dynamodb').get_item(
+                TableName=self.table,
+                Key={
+                    'Id': {
+                        'S': key,
+                        },
+                    },
+                ConsistentRead=True).get('Item')
+        if item is None:
+            return None
+        return json.loads(item['State']['S'])
+
+    def save(self, key, state):
+        utilities.boto3_client('dynamodb').put_item(
+                TableName=self.table,
+                Item={
+                    'Id': {
+                        'S': key,
+                        },
+                    'State': {
+                        'S': json.dumps(state),
+                        },
+                    'ExpiresAt': {
+                        'N': f'{int(time()) + checkpoint_ttl}',
+                        },
+                    })
+
+    def delete(self, key):
+        utilities.boto3_client('dynamodb').delete_item(
+                TableName=self.table,
+                Key={
+                    'Id': {
+                        'S': key,
+                        },
+                    })
+
+
+def checkpoint_store():
+    if checkpoint_table:
+        return DynamoDBCheckpoints(checkpoint_table)
+    return FileCheckpoints(checkpoint_dir)
+
+
+class Checkpoint:
+    '''
+    Progress of one custom resource request across invocations: the pairs
+    done so far, and the pairs deferred as the deadline got close
+    '''
+    def __init__(self, event, context, store=None):
+        self.store = store if store is not None else checkpoint_store()
+        self.key = utilities.mk_digest(
+                [
+                    event['StackId'],
+                    event['RequestId'],
+                    event['LogicalResourceId'],
+                    ]
+                )
+
+        # no context, no deadline (local runs)
+        self.deadline = None
+        if context is not None:
+            self.deadline = monotonic() - deadline_margin + \
+                context.get_remaining_time_in_millis() / 1000
+
+        state = self.store.load(self.key) or dict()
+        self.done = set([
+            tuple(pair)
+            for pair
+            in state.get('done', list())
+            ])
+        self.invocations = state.get('invocations', 0) + 1
+        self.deferred = 0
+        self.lock = threading.Lock()
+
+    def remaining(self):
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - monotonic())
+
+    def expired(self):
+        return self.deadline is not None and monotonic() >= self.deadline
+
+    def complete(self, pair):
+        with self.lock:
+            self.done.add(pair)
+
+    def defer(self, count=1):
+        with self.lock:
+            self.deferred += count
+
+    def save(self):
+        self.store.save(self.key, {
+            'done': sorted(self.done),
+            'invocations': self.invocations,
+            })
+
+    def clear(self):
+        self.store.delete(self.key)
+
+
+def continue_later(event, context):
+    '''
+    Same request again, in a new invocation of this function
+    '''
+    utilities.metrics.count('Continuations')
+    utilities.boto3_client('lambda').invoke(
+            FunctionName=context.invoked_function_arn,
+            InvocationType='Event',
+            Payload=json.dumps(event))
+
 
 def handler(event, context):
     logger.debug(f'Running AutoAssociate: {event}')
 
-    try:
-        if event['RequestType'] in ['Create', 'Update']:
-            logger.debug(f'Processing: {event["RequestType"]}')
-            sync_remote_associations(event, context)
+    with utilities.metrics.invocation('CFNAutoAssociate'):
+        checkpoint = None
+        try:
+            if sync_function(event) is not None:
+                checkpoint = Checkpoint(event, context)
 
-        else:
-            logger.debug(f'Processing: {event["RequestType"]}; NOOP')
+            if not process(event, context, checkpoint):
+                return  # CFN is answered by the last invocation
 
-        utilities.send_response('SUCCESS', 'OK', event, context)
+            utilities.send_response('SUCCESS', 'OK', event, context)
+
+        except Exception as e:
+            utilities.metrics.count('Errors')
+            utilities.send_response('FAILED', f'{e}', event, context)
+
+        if checkpoint is not None:
+            checkpoint.clear()
+
+
+def sync_function(event):
+    '''
+    The sync for the request; None when there is nothing to do
+    '''
+    if 'VpcId' in event['ResourceProperties']:
+        return sync_vpc_associations
+
+    if event['RequestType'] not in ['Create', 'Update']:
+        return None
+
+    if 'Principals' in event['ResourceProperties']:
+        return sync_share_associations
+
+    return sync_remote_associations
 
-    except Exception as e:
-        utilities.send_response('FAILED', f'{e}', event, context)
+
+def process(event, context, checkpoint=None):
+    '''
+    Returns False when the work continues in another invocation
+    '''
+    if checkpoint is not None and checkpoint.invocations > max_invocations:
+        raise RuntimeError(f'not done after {max_invocations} invocations')
+
+    sync = sync_function(event)
+    if sync is None:
+        logger.debug(f'Processing: {event["RequestType"]}; NOOP')
+    else:
+        logger.debug(f'Processing: {event["RequestType"]}; {sync.__name__}')
+        sync(event, context, checkpoint)
+
+    if checkpoint is not None and checkpoint.deferred:
+        logger.debug(f'Deadline: {checkpoint.deferred} pairs deferred,'
+                     f' {len(checkpoint.done)} done')
+        utilities.metrics.count('DeferredPairs', checkpoint.deferred)
+        checkpoint.save()
+        continue_later(event, context)
+        return False
+
+    return True
 
 
 def generate_access_token(event, context):
-    role_arn = {
-            'RoleArn': event['ResourceProperties']['RoleARN'],
-            'RoleSessionName': 'cross_account_lambda'
-            }
+    return utilities.assume_role(event['ResourceProperties']['RoleARN'])
 
-    peer = boto3.client('sts').assume_role(**role_arn)['Credentials']
 
-    return {
-            'aws_access_key_id': peer['AccessKeyId'],
-            'aws_secret_access_key': peer['SecretAccessKey'],
-            'aws_session_token': peer['SessionToken'],
-            }
+def associate_pair(pair, access_token=dict()):
+    utilities.boto3_call('associate_resolver_rule',
+                         request={
+                             'VPCId': pair[0],
+                             'ResolverRuleId': pair[1],
+                             'Name': utilities.auto_association_name,
+                             },
+                         access_token=access_token)
 
 
-def sync_remote_associations(event, context):
-    access_token = generate_access_token(event, context)
+def disassociate_pair(pair, access_token=dict()):
+    utilities.boto3_call('disassociate_resolver_rule',
+                         request={
+                             'VPCId': pair[0],
+                             'ResolverRuleId': pair[1],
+                             },
+                         access_token=access_token)
+
+
+def account_slot(account):
+    with account_slots_lock:
+        if account not in account_slots:
+            account_slots[account] = \
+                threading.BoundedSemaphore(max_account_calls)
+        return account_slots[account]
+
+
+def attempt_pair(apply, pair, access_token, account, checkpoint=None):
+    '''
+    Returns the error instead of raising it, so all the pairs are tried;
+    pairs are left for the next invocation once the deadline is close
+    '''
+    try:
+        with account_slot(account):
+            if checkpoint is not None and checkpoint.expired():
+                checkpoint.defer()
+                return None
+            apply(pair, access_token)
+    except Exception as e:
+        logger.debug(f'{account}: {apply.__name__} {pair}: {e}')
+        return e
+
+    if checkpoint is not None:
+        checkpoint.complete(pair)
+
+
+def apply_associations(need, have, access_token=dict(), account='local',
+                       checkpoint=None):
+    '''
+    Removes `have - need`, then creates `need - have` on a bounded worker
+    pool. Every pair is tried (or deferred by `checkpoint`), returns the
+    failures as {pair: error}.
+    '''
+    if checkpoint is not None:
+        # done by previous invocations, may not be listed yet
+        need = need - set([
+            pair
+            for pair
+            in checkpoint.done
+            if pair not in have
+            ])
+        have = have - set([
+            pair
+            for pair
+            in checkpoint.done
+            if pair not in need
+            ])
+
+    utilities.metrics.count('Disassociations', len(have - need))
+    utilities.metrics.count('Associations', len(need - have))
 
-    local_exported_rules = set([
+    failures = dict()
+    for pairs, apply in [
+            (sorted(have - need), disassociate_pair),
+            (sorted(need - have), associate_pair),
+            ]:
+        errors = utilities.fan_out([
+            partial(attempt_pair, apply, pair, access_token, account,
+                    checkpoint)
+            for pair
+            in pairs
+            ], max_workers=association_workers)
+
+        failures.update([
+            (pair, error)
+            for pair, error
+            in zip(pairs, errors)
+            if error is not None
+            ])
+
+    utilities.metrics.count('AssociationFailures', len(failures))
+
+    return failures
+
+
+def wait_for_rules(rule_ids, access_token, deadline=readiness_deadline):
+    '''
+    Polls the rules visible to `access_token` until all of `rule_ids` are
+    there or `deadline` seconds passed; returns the ones still missing
+    '''
+    started = monotonic()
+    delay = readiness_delay
+    missing = set(rule_ids)
+
+    while missing:
+        utilities.metrics.count('ReadinessPolls')
+        missing -= set([
+            remote_rule['Id']
+            for remote_rule
+            in utilities.boto3_call('list_resolver_rules',
+                                    access_token=access_token,
+                                    cache=True)
+            ])
+
+        if not missing or monotonic() - started + delay > deadline:
+            return missing
+
+        logger.debug(f'=== Not found: {len(missing)} rules (retrying) ===')
+        sleep(delay)
+        delay = min(delay * 2, readiness_max_delay)
+
+        # cached listing is older than the share; drop it
+        utilities.invalidate_cache(['list_resolver_rules'], access_token)
+
+    return missing
+
+
+def failure_summary(account, failures, domains=dict()):
+    '''
+    One error message for all the failed pairs
+    '''
+    reported = [
+            f'RR {rule_id} {domains.get(rule_id, "")} / VPC {vpc}: {error}'
+            for (vpc, rule_id), error
+            in sorted(failures.items())[:max_reported_failures]
+            ]
+    if len(failures) > max_reported_failures:
+        reported.append(f'and {len(failures) - max_reported_failures}'
+                        f' more')
+
+    return f'{account}: {len(failures)} association changes failed; ' + \
+        '; '.join(reported)
+
+
+def sync_vpc_associations(event, context, checkpoint=None):
+    '''
+    Bulk mode: associations of the stack rules to one local VPC
+    '''
+    properties = event['ResourceProperties']
+    vpc = properties['VpcId']
+
+    # rules dropped from the template are still associated; clean them up
+    managed = set(properties['RuleIds']) | set(
+            event.get('OldResourceProperties', dict()).get('RuleIds', list()))
+
+    need = set()
+    if event['RequestType'] != 'Delete':
+        need = set([
+            (vpc, rule_id)
+            for rule_id
+            in properties['RuleIds']
+            ])
+
+    have = set([
+        (
+            association['VPCId'],
+            association['ResolverRuleId']
+            )
+        for association
+        in utilities.boto3_call('list_resolver_rule_associations',
+                                filters={
+                                    'VPCId': vpc,
+                                    'ResolverRuleId': managed,
+                                    })
+        ])
+    logger.debug(f'{vpc}: needs {len(need)}, has {len(have)}')
+
+    failures = apply_associations(need, have, checkpoint=checkpoint)
+    if failures:
+        raise RuntimeError(failure_summary(vpc, failures))
+
+
+def share_rules(share_arn):
+    '''
+    IDs of the resolver rules in our RAM share
+    '''
+    return set([
         re.sub('^.*\\/', '', resource['arn'])
         for resource
         in utilities.boto3_call('list_resources',
                                 request={
                                     'resourceOwner': 'SELF'
+                                    },
+                                filters={
+                                    'resourceShareArn': share_arn,
+                                    'type': 'route53resolver:ResolverRule',
                                     })
-        if resource['resourceShareArn']
-        == event['ResourceProperties']['ShareArn']
-        and resource['type']
-        == 'route53resolver:ResolverRule'
         ])
 
+
+def reconcile_account(account, access_token, local_exported_rules, vpc_dni,
+                      checkpoint=None):
+    '''
+    Associates our shared rules to the VPCs `account` exports; returns the
+    failures as {pair: error}
+    '''
     remote_exported_vpcs = set([
         export['Value']
         for export
@@ -67,11 +474,10 @@ def sync_remote_associations(event, context):
 
     # `need`: associations we should have
     need = set()
-    for vpc in remote_exported_vpcs - \
-            set(event['ResourceProperties']['VpcDni']):
+    for vpc in remote_exported_vpcs - set(vpc_dni):
         for rule_id in local_exported_rules:
             need.add((vpc, rule_id))
-    logger.debug(f'local needs: {need}')
+    logger.debug(f'{account}: local needs: {need}')
 
     # `have`: associations we actually have
     have = set([
@@ -81,63 +487,111 @@ def sync_remote_associations(event, context):
             )
         for association
         in utilities.boto3_call('list_resolver_rule_associations',
-                                access_token=access_token)
-        if association['ResolverRuleId'] in local_exported_rules
+                                access_token=access_token,
+                                filters={
+                                    'ResolverRuleId': local_exported_rules,
+                                    })
         ])
-    logger.debug(f'remote has: {have}')
+    logger.debug(f'{account}: remote has: {have}')
 
-    remote_rules = [
-            remote_rule['Id']
-            for remote_rule
-            in utilities.boto3_call('list_resolver_rules',
-                                    access_token=access_token)
-            ]
-    logger.debug(f'=== {remote_rules} ===')
-
-    # remove extra first
-    for pair in have - need:
-        logger.debug(f'Removing: {pair}')
-        utilities.boto3_call('disassociate_resolver_rule',
-                             request={
-                                 'VPCId': pair[0],
-                                 'ResolverRuleId': pair[1],
-                                 },
-                             access_token=access_token)
-
-    # create missing; format error nicely as this happens often
-    remote_rules = list()
-    for pair in need - have:
-        logger.debug(f'>>> Creating: {pair} <<<')
+    # one readiness phase for all the rules, instead of polling per pair
+    deadline = readiness_deadline
+    if checkpoint is not None and checkpoint.deadline is not None:
+        deadline = min(deadline, checkpoint.remaining())
+
+    missing = wait_for_rules(set([
+        rule_id
+        for _, rule_id
+        in need - have
+        ]), access_token, deadline)
+    if missing and deadline < readiness_deadline:
+        # out of time rather than patience; the next invocation waits on
+        deferred = set([
+            pair
+            for pair
+            in need - have
+            if pair[1] in missing
+            ])
+        checkpoint.defer(len(deferred))
+        need -= deferred
+
+    elif missing:
+        # ready or not - attempt to associate, failures are reported
+        logger.debug(f'=== {account}: not found after'
+                     f' {readiness_deadline}s: {missing} ===')
+
+    return apply_associations(need, have, access_token, account, checkpoint)
+
+
+def raise_failures(failures):
+    '''
+    `failures`: {account: {pair: error} or error}; format errors nicely
+    as this happens often
+    '''
+    failures = dict([
+        (account, errors)
+        for account, errors
+        in failures.items()
+        if errors
+        ])
+    if not failures:
+        return
+
+    domains = dict([
+        (rr['Id'], rr['DomainName'])
+        for rr
+        in utilities.boto3_call('list_resolver_rules', cache=True)
+        ])
+    raise RuntimeError(' | '.join([
+        f'{account}: {errors}'
+        if isinstance(errors, Exception)
+        else failure_summary(account, errors, domains)
+        for account, errors
+        in sorted(failures.items())
+        ]))
+
+
+def sync_remote_associations(event, context, checkpoint=None):
+    access_token = generate_access_token(event, context)
+
+    account = re.sub('^arn:aws:iam::(\\d+):.*', '\\1',
+                     event['ResourceProperties']['RoleARN'])
+
+    raise_failures({
+        account: reconcile_account(
+            account,
+            access_token,
+            share_rules(event['ResourceProperties']['ShareArn']),
+            event['ResourceProperties']['VpcDni'],
+            checkpoint),
+        })
+
+
+def sync_share_associations(event, context, checkpoint=None):
+    '''
+    Share scope: all the principals of the share, reconciled in parallel
+    '''
+    properties = event['ResourceProperties']
+    principals = sorted(properties['Principals'])
+
+    # listed once for all the principals
+    local_exported_rules = share_rules(properties['ShareArn'])
+
+    def reconcile(principal):
         try:
-            for _ in range(3):
-                if pair[1] in remote_rules:
-                    logger.debug('=== Found! ===')
-                    break
-                logger.debug(f'=== Not found: {pair[1]} (retrying) ===')
-                remote_rules = [
-                        remote_rule['Id']
-                        for remote_rule
-                        in utilities.boto3_call('list_resolver_rules',
-                                                access_token=access_token)
-                        ]
-
-            # ready or not - attempt to associate; raises on error
-            utilities.boto3_call('associate_resolver_rule',
-                                 request={
-                                     'VPCId': pair[0],
-                                     'ResolverRuleId': pair[1],
-                                     'Name': 'Do not remove manually',
-                                     },
-                                 access_token=access_token)
+            access_token = utilities.assume_role(
+                    f'arn:aws:iam::{principal}:role/{properties["RoleName"]}')
+            return reconcile_account(principal,
+                                     access_token,
+                                     local_exported_rules,
+                                     properties['VpcDni'],
+                                     checkpoint)
         except Exception as e:
-            account = re.sub('^arn:aws:iam::(\\d+):.*', '\\1',
-                             event['ResourceProperties']['RoleARN'])
-            domain = [
-                    rr['DomainName']
-                    for rr
-                    in utilities.boto3_call('list_resolver_rules')
-                    if rr['Id'] == pair[1]
-                    ]
-            raise RuntimeError(f'{account}: failed to associate RR {pair[1]}'
-                               f' {domain}'
-                               f' to the VPC {pair[0]} : {e}') from e
+            # other accounts go on; reported with the association failures
+            return e
+
+    raise_failures(dict(zip(principals, utilities.fan_out([
+        partial(reconcile, principal)
+        for principal
+        in principals
+        ]))))
@@ -6,17 +6,18 @@ import utilities
 
 
 def handler(event, context):
-    try:
-        return create_template(event, context)
+    with utilities.metrics.invocation('CFNEndpointsTransform'):
+        try:
+            return create_template(event, context)
 
-    except Exception as e:
-
-        return {
-                'requestId': event['requestId'],
-                'status': 'BIGBADABOOM',  # anything but SUCCESS is a failure
-                'fragment': event['fragment'],
-                'errorMessage': f'{e}: {traceback.format_exc()}',
-                }
+        except Exception as e:
+            utilities.metrics.count('Errors')
+            return {
+                    'requestId': event['requestId'],
+                    'status': 'BIGBADABOOM',  # anything but SUCCESS fails
+                    'fragment': event['fragment'],
+                    'errorMessage': f'{e}: {traceback.format_exc()}',
+                    }
 
 
 def count_exported_subnets(event, context):
@@ -25,14 +26,16 @@ def count_exported_subnets(event, context):
             '-' + re.sub("(.).*?-", "\\1", event['region']) + \
             '-vpc-stk-PrivateSubnet(\\d)-Id'
 
-    count = 0
+    count, limit = 0, int(event['templateParameterValues']['MaxIpAddresses'])
 
-    exports = utilities.boto3_call('list_exports')
-    for export in exports:
+    # stop paginating as soon as there are enough subnets
+    for export in utilities.iter_boto3('list_exports'):
         if re.match(m, export['Name']):
             count += 1
+            if count >= limit:
+                break
 
-    return min(count, int(event['templateParameterValues']['MaxIpAddresses']))
+    return min(count, limit)
 
 
 def create_template(event, context):
@@ -177,6 +180,8 @@ def create_template(event, context):
                 },
             }
 
+    utilities.metrics.resources(resources)
+
     return {
             'status': 'SUCCESS',
             'requestId': event['requestId'],
@@ -1,13 +1,24 @@
 #!/usr/bin/env python3
 from argparse import Namespace
 from copy import deepcopy
-from datetime import datetime
+from functools import partial
+import heapq
+import json
 import logging
+import math
 import re
 import traceback
 import utilities
 
 
+# CloudFormation quotas for a single stack
+max_stack_resources = 500
+max_template_bytes = 1024 * 1024
+max_mapping_attributes = 200
+
+# Mappings entry holding the values factored out by compact_fragment
+compact_mapping = 'WexCompact'
+
 logger = logging.getLogger('CFNZonesTransform')
 logger.setLevel(logging.DEBUG)
 ch = logging.StreamHandler()
@@ -16,16 +27,18 @@ logger.addHandler(ch)
 
 
 def handler(event, context):
-    try:
-        return create_template(event, context)
-
-    except Exception as e:
-        return {
-                'requestId': event['requestId'],
-                'status': 'BIGBADABOOM',  # anything but SUCCESS is a failure
-                'fragment': event['fragment'],
-                'errorMessage': f'{e}: {event} {traceback.format_exc()}',
-                }
+    with utilities.metrics.invocation('CFNZonesTransform'):
+        try:
+            return create_template(event, context)
+
+        except Exception as e:
+            utilities.metrics.count('Errors')
+            return {
+                    'requestId': event['requestId'],
+                    'status': 'BIGBADABOOM',  # anything but SUCCESS fails
+                    'fragment': event['fragment'],
+                    'errorMessage': f'{e}: {event} {traceback.format_exc()}',
+                    }
 
 
 def is_local_test(parm):  # TODO: remove
@@ -38,22 +51,32 @@ def retrieve_cfn_export(event, wex, export):
     export_name = utilities.import_value(event, wex, export)
     export_name = export_name['Fn::ImportValue']
 
-    for export in utilities.boto3_call('list_exports'):
+    for export in utilities.iter_boto3('list_exports', cache=True):
         if export['Name'] == export_name:
             return export['Value']
 
     raise RuntimeError(f'{export_name} not found in CFN exports')
 
 
-def retrieve_logical_id(parm, name, match):
-    if name == 'DomainName':
-        aws_type = 'AWS::Route53Resolver::ResolverRule'
-    else:
-        aws_type = 'AWS::Route53Resolver::ResolverRule'
+def add_resource(parm, resource_id, resource):
+    '''
+    Inserts into the fragment and keeps `parm.index` up to date:
+        'Type': AWS type -> [LogicalId, ..]
+        'DomainName': rule DomainName -> LogicalId
+    '''
+    parm.resources[resource_id] = resource
+
+    parm.index['Type'].setdefault(resource['Type'], list()) \
+        .append(resource_id)
 
-    for k, v in parm.resources.items():
-        if v['Type'] == aws_type and v['Properties'][name] == match:
-            return k
+    if resource['Type'] == 'AWS::Route53Resolver::ResolverRule':
+        parm.index['DomainName'][resource['Properties']['DomainName']] = \
+            resource_id
+
+
+def retrieve_logical_id(parm, name, match):
+    if match in parm.index.get(name, dict()):
+        return parm.index[name][match]
     raise ValueError(f'Can\'t find LogicalId for: {name}')
 
 
@@ -122,6 +145,37 @@ def resource_rule_association(parm, vpc_id, rule_id):
             )
 
 
+def resource_vpc_associate(parm, vpc_id, rule_ids):
+    return (
+            utilities.mk_id(
+                [
+                    f'cr{parm.kind}VpcAssoc',
+                    parm.region_name,
+                    parm.target_env,
+                    vpc_id,
+                    ]
+                ),
+            {
+                'Type': 'AWS::CloudFormation::CustomResource',
+                'Properties': {
+                    'ServiceToken':
+                        utilities.import_value(
+                            parm.event,
+                            parm.wex,
+                            'auto_associate_function'
+                            ),
+                    'VpcId': vpc_id,
+                    'RuleIds': [
+                        utilities.fn_get_att(rule_id, 'ResolverRuleId')
+                        for rule_id
+                        in sorted(rule_ids)  # stable; any change re-syncs
+                        ],
+                    'ForceRefresh': parm.force_refresh,
+                    },
+                }
+            )
+
+
 def resource_share(parm, zone_slot, zone_list, principal_slot, principal_list):
     friendly_name = parm.share_prefix + '-' + \
             ('%04x' % principal_slot) + \
@@ -172,7 +226,18 @@ def resource_share(parm, zone_slot, zone_list, principal_slot, principal_list):
             )
 
 
-def resource_auto_associate(parm, share_id, principal):
+def resource_auto_associate(parm, share_id, zone_list, principal):
+    # CFN re-invokes the custom resource only when the digest changes
+    digest = utilities.mk_digest(
+            [
+                sorted(zone_list),
+                principal,
+                sorted(parm.region_data['VpcDni']),
+                parm.event['templateParameterValues']['CrossAccountRoleName'],
+                parm.force_refresh,
+                ]
+            )
+
     return (
             utilities.mk_id(
                 [
@@ -213,7 +278,7 @@ def resource_auto_associate(parm, share_id, principal):
                             ],
                         },
                     'ShareArn': utilities.fn_get_att(share_id, 'Arn'),
-                    'LastUpdated': datetime.isoformat(datetime.now()),
+                    'Digest': digest,
                     },
                 'DependsOn': [
                     share_id,
@@ -222,87 +287,232 @@ def resource_auto_associate(parm, share_id, principal):
             )
 
 
+def resource_share_auto_associate(parm, share_id, zone_list, principal_list):
+    # CFN re-invokes the custom resource only when the digest changes
+    digest = utilities.mk_digest(
+            [
+                sorted(zone_list),
+                sorted(principal_list),
+                sorted(parm.region_data['VpcDni']),
+                parm.event['templateParameterValues']['CrossAccountRoleName'],
+                parm.force_refresh,
+                ]
+            )
+
+    return (
+            utilities.mk_id(
+                [
+                    f'cr{parm.kind}ShareAutoAssoc',
+                    parm.region_name,
+                    parm.target_env,
+                    share_id,
+                    ]
+                ),
+            {
+                'Type': 'AWS::CloudFormation::CustomResource',
+                'Properties': {
+                    'ServiceToken':
+                        utilities.import_value(
+                            parm.event,
+                            parm.wex,
+                            'auto_associate_function'
+                            ),
+                    'VpcDni': parm.region_data['VpcDni'],
+                    'Principals': principal_list,
+                    'RoleName': {
+                        'Ref': 'CrossAccountRoleName',
+                        },
+                    'ShareArn': utilities.fn_get_att(share_id, 'Arn'),
+                    'Digest': digest,
+                    },
+                'DependsOn': [
+                    share_id,
+                    ]
+                }
+            )
+
+
+def load_existing_shares(parm):
+    '''
+    RAM shares managed by this stack, with their rules and principals
+    '''
+    parm.ram_shares = utilities.boto3_call('get_resource_shares',
+                                           request={
+                                               'resourceOwner': 'SELF',
+                                               },
+                                           filters={
+                                               'status': 'ACTIVE',
+                                               },
+                                           cache=True)
+    parm.managed_shares = managed_shares(parm)
+
+    # list the managed shares only, not every share of the account
+    share_arns = [
+            share['resourceShareArn']
+            for share
+            in parm.managed_shares
+            ]
+    if not share_arns:
+        parm.ram_resources, parm.ram_principals = list(), list()
+        return
+
+    parm.ram_resources, parm.ram_principals = utilities.fan_out([
+        partial(utilities.boto3_call,
+                'list_resources',
+                request={
+                    'resourceOwner': 'SELF',
+                    },
+                filters={
+                    'resourceShareArn': share_arns,
+                    'type': 'route53resolver:ResolverRule',
+                    },
+                cache=True),
+        partial(utilities.boto3_call,
+                'list_principals',
+                request={
+                    'resourceOwner': 'SELF',
+                    'resourceType': 'route53resolver:ResolverRule',
+                    },
+                filters={
+                    'resourceShareArn': share_arns,
+                    },
+                cache=True),
+        ])
+
+
 def load_existing_data(parm):
-    parm.ram_shares = \
-        utilities.boto3_call('get_resource_shares',
-                             request={
-                                 'resourceOwner': 'SELF',
-                                 }
-                             )
-
-    parm.ram_resources = \
-        utilities.boto3_call('list_resources',
-                             request={
-                                 'resourceOwner': 'SELF',
-                                 'resourceType':
-                                 'route53resolver:ResolverRule',
-                                 }
-                             )
-
-    parm.ram_principals = \
-        utilities.boto3_call('list_principals',
-                             request={
-                                 'resourceOwner': 'SELF',
-                                 'resourceType':
-                                 'route53resolver:ResolverRule',
-                                 }
-                             )
-
-    parm.r53resolver_rules = \
-        utilities.boto3_call('list_resolver_rules')
+    _, parm.r53resolver_rules = utilities.fan_out([
+        partial(load_existing_shares, parm),
+        partial(utilities.boto3_call,
+                'list_resolver_rules',
+                filters={
+                    'Status': 'COMPLETE',
+                    },
+                cache=True),
+        ])
+
+
+def load_association_owners(parm):
+    '''
+    (VPC, zone) -> `Bulk` for the existing associations made by
+    CFNAutoAssociate, `Resource` for the other ones; local rules only
+    '''
+    parm.association_owners = dict()
+    if not parm.vpcs:
+        return
+
+    zones = dict([
+        (rule['Id'], rule['DomainName'])
+        for rule
+        in parm.r53resolver_rules
+        if rule.get('OwnerId') == parm.event['accountId']
+        ])
+
+    for associations in utilities.fan_out([
+            partial(utilities.boto3_call,
+                    'list_resolver_rule_associations',
+                    filters={
+                        'VPCId': vpc_id,
+                        })
+            for vpc_id
+            in parm.vpcs
+            ]):
+        for association in associations:
+            if association['ResolverRuleId'] not in zones or \
+                    association['Status'] == 'FAILED':
+                continue
+
+            owner = 'Resource'
+            if association.get('Name') == utilities.auto_association_name:
+                owner = 'Bulk'
+
+            parm.association_owners[(
+                association['VPCId'],
+                zones[association['ResolverRuleId']],
+                )] = owner
+
+
+def managed_shares(parm):
+    '''
+    Active RAM shares created by this stack (matched by name)
+    '''
+    pattern = re.compile(parm.share_prefix + '-\\d{8}$')
+
+    return [
+            share
+            for share
+            in parm.ram_shares
+            if pattern.match(share['name'])
+            and share['status'] == 'ACTIVE'
+            ]
+
+
+def group_by_share(items):
+    groups = dict()
+    for item in items:
+        groups.setdefault(item['resourceShareArn'], list()).append(item)
+    return groups
 
 
 def join_resources(parm):
+    domain_names = dict([
+        (rule['Arn'], rule['DomainName'])
+        for rule
+        in parm.r53resolver_rules
+        if rule['Status'] == 'COMPLETE'
+        ])
+
+    resources = group_by_share([
+        resource
+        for resource
+        in parm.ram_resources
+        if resource['type'] == 'route53resolver:ResolverRule'
+        ])
+
     return dict(
             [
                 (
                     int(share['name'][-4:], 16),
                     [
-                        [
-                            rule['DomainName']
-                            for rule in parm.r53resolver_rules
-                            if resource['arn'] == rule['Arn']
-                            and rule['Status'] == 'COMPLETE'
-                            ][0]
-                        for resource in parm.ram_resources
-                        if resource['type'] == 'route53resolver:ResolverRule'
-                        and resource['resourceShareArn']
-                        == share['resourceShareArn']
+                        domain_names[resource['arn']]
+                        for resource
+                        in resources.get(share['resourceShareArn'], list())
                         ]
                     )
-                for share in [
-                    share for share
-                    in parm.ram_shares
-                    if re.match(parm.share_prefix + '-\\d{8}$', share['name'])
-                    and share['status'] == 'ACTIVE'
-                    ]
+                for share in parm.managed_shares
                 ]
             )
 
 
 def join_principals(parm):
+    principals = group_by_share(parm.ram_principals)
+
     return dict(
             [
                 (
                     int(share['name'][-8:-4], 16),
                     [
                         principal['id']
-                        for principal in parm.ram_principals
-                        if principal['resourceShareArn']
-                        == share['resourceShareArn']
+                        for principal
+                        in principals.get(share['resourceShareArn'], list())
                         ]
                     )
-                for share in [
-                    share for share
-                    in parm.ram_shares
-                    if re.match(parm.share_prefix + '-\\d{8}$', share['name'])
-                    and share['status'] == 'ACTIVE'
-                    ]
+                for share in parm.managed_shares
                 ]
             )
 
 
 def pre_to_post(pre, new_objs, max_objs):
+    '''
+    First-fit slot allocation. Objects keep their slot from `pre` (up to
+    `max_objs` per slot) so RAM shares don't churn; the rest goes, sorted,
+    to the lowest numbered slot with free capacity. When all slots are full
+    the lowest unused number becomes a new slot. Consumes `new_objs`.
+    '''
+    max_objs = int(max_objs)
+    if max_objs < 1:
+        raise ValueError(f'Slot capacity should be positive: {max_objs}')
+
     post = dict(
             [
                 (
@@ -314,34 +524,257 @@ def pre_to_post(pre, new_objs, max_objs):
                 ]
             )
 
+    pending = set(new_objs)
+
     for idx in pre:
         new_idx = int(idx)  # use `idx` as-is, make `new_idx` int
         for old_obj in sorted(pre[idx]):
-            if old_obj in new_objs and \
-                    len(post[new_idx]) < int(max_objs):
+            if old_obj in pending and \
+                    len(post[new_idx]) < max_objs:
                 post[new_idx].append(old_obj)
-                new_objs.remove(old_obj)
+                pending.remove(old_obj)
 
-    serial = 0  # start scanning from zero
-    while True:
-        for new_obj in sorted(new_objs):
-            for idx in sorted(post):
-                if len(post[idx]) < int(max_objs):
-                    post[idx].append(new_obj)
-                    new_objs.remove(new_obj)
-                    break
+    # slot numbers with free capacity; the lowest one is always at [0]
+    free = [idx for idx in post if len(post[idx]) < max_objs]
+    heapq.heapify(free)
 
-        if not new_objs:
-            break
+    serial = 0  # start scanning from zero
+    for new_obj in sorted(pending):
+        if not free:
+            while serial in post:
+                serial += 1
+            post[serial] = list()
+            heapq.heappush(free, serial)
 
-        while serial in post:
-            serial += 1
+        post[free[0]].append(new_obj)
+        if len(post[free[0]]) >= max_objs:
+            heapq.heappop(free)
 
-        post[serial] = list()
+    new_objs.clear()
 
     return post
 
 
+def zone_shard(zone, shard_count):
+    '''
+    Stable across runs and Python versions; depends on the zone name only
+    '''
+    return int(utilities.mk_digest([zone]), 16) % shard_count
+
+
+def shard_hint(parm, size):
+    '''
+    How to redeploy within the limits. Rules and their associations split
+    across the shards, however shares and their auto-associations repeat
+    in every zone slot of a shard and the other resources (eg. per-VPC
+    ones) in every shard.
+    '''
+    types = parm.index['Type']
+    zones = len(types.get('AWS::Route53Resolver::ResolverRule', list()))
+    if not zones:
+        return 'no zone to split across shards'
+
+    per_zone = (zones + len(types.get(
+        'AWS::Route53Resolver::ResolverRuleAssociation', list()))) / zones
+    per_slot = sum([
+        1 + (1 if parm.auto_associate_scope == 'Share' else len(principals))
+        for principals
+        in parm.principal_post.values()
+        ])
+    fixed = len(parm.resources) - per_zone * zones - \
+        per_slot * len(parm.infra_post)
+
+    # Bulk RuleIds grow with the zones of the shard, not with the resources
+    rule_ids_bytes = sum([
+        len(json.dumps(resource['Properties']['RuleIds']))
+        for resource
+        in parm.resources.values()
+        if 'RuleIds' in resource.get('Properties', dict())
+        ])
+    bytes_per_resource = (size - rule_ids_bytes) / len(parm.resources)
+
+    def fits(shard_zones, slots=None):
+        if slots is None:
+            slots = math.ceil(shard_zones / int(parm.max_rules))
+        resources = fixed + per_zone * shard_zones + per_slot * slots
+        size = resources * bytes_per_resource + \
+            rule_ids_bytes * shard_zones / zones
+        return resources <= max_stack_resources and \
+            size <= max_template_bytes
+
+    bulk = 'use VpcAssociationMode=Bulk'
+    if parm.vpc_association_mode == 'Bulk':
+        bulk = 'use fewer VPCs'
+
+    if not fits(1, slots=0):
+        return 'no ShardCount fits, the rule and VPC associations of a' \
+            f' single zone are over the limits: {bulk}'
+
+    if not fits(1):
+        return 'no ShardCount fits, the shares and auto-associations of a' \
+            ' single zone slot are over the limits: use fewer principals' \
+            ' or AutoAssociateScope=Share'
+
+    # largest shard within the limits, fits() grows with the zones
+    per_shard = 1
+    while per_shard < zones and fits(per_shard + 1):
+        per_shard += 1
+
+    # zones don't hash evenly: size the fullest shard, as `zone_shard` would;
+    # past one shard per zone more shards no longer spread them
+    digests = [
+            int(utilities.mk_digest([zone]), 16)
+            for zone
+            in clean_zone_names(parm.wex[parm.kind])
+            ]
+    lowest = math.ceil(len(digests) / per_shard)
+    for shard_count in range(lowest, len(digests) + 1):
+        shards = dict()
+        for digest in digests:
+            shards[digest % shard_count] = \
+                shards.get(digest % shard_count, 0) + 1
+
+        if max(shards.values()) <= per_shard:
+            return f'redeploy with ShardCount >= {shard_count}'
+
+    return f'no ShardCount up to {len(digests)} puts at most {per_shard}' \
+        f' zones in every shard: {bulk}'
+
+
+def check_limits(parm, fragment):
+    '''
+    Fail with a hint instead of letting CloudFormation reject the stack
+    '''
+    size = len(json.dumps(fragment, default=str))
+
+    if len(parm.resources) <= max_stack_resources and \
+            size <= max_template_bytes:
+        return
+
+    message = f'{len(parm.resources)} resources, {size} bytes exceed' \
+        f' a single stack'
+
+    message += f'; {shard_hint(parm, size)}'
+
+    if is_local_test(parm):
+        logger.warning(message)  # benchmarks go past the limits on purpose
+        return
+
+    raise RuntimeError(message)
+
+
+def compact_candidates(properties):
+    '''
+    (parent, key, mapping key) of the values Fn::FindInMap can stand for:
+    strings and string lists of the properties, export names of
+    Fn::ImportValue
+    '''
+    for name, value in properties.items():
+        if isinstance(value, str) or isinstance(value, list) and value and \
+                all(isinstance(x, str) for x in value):
+            yield properties, name, name
+
+        elif isinstance(value, dict) and \
+                isinstance(value.get('Fn::ImportValue'), str):
+            yield value, 'Fn::ImportValue', 'ImportValue'
+
+
+def compact_fragment(parm, fragment):
+    '''
+    Shrink the fragment without changing what CloudFormation deploys;
+    returns the bytes saved
+    '''
+    before = len(json.dumps(fragment, default=str))
+
+    # stack tags (deploy scripts pass the same list) cover the common ones
+    common_tags = parm.wex['Tags'] if parm.stack_level_tags else list()
+
+    # repeated values (eg. ServiceToken, endpoint exports, share principals)
+    # move to Mappings when the lookups are shorter than the copies
+    values = dict()
+    for resource in fragment['Resources'].values():
+        properties = resource['Properties']
+
+        if common_tags and 'Tags' in properties:
+            properties['Tags'] = [
+                    tag
+                    for tag
+                    in properties['Tags']
+                    if tag not in common_tags
+                    ]
+
+        for parent, key, name in compact_candidates(properties):
+            value = (name, json.dumps(parent[key]))
+            values[value] = values.get(value, 0) + 1
+
+    mapping = dict()
+    lookups = dict()
+    saved = dict()  # name -> bytes
+    for (name, value), count in values.items():
+        if count < 2:
+            continue
+
+        attributes = mapping.setdefault(name, dict())
+        saved.setdefault(name, 0)
+        if len(attributes) >= max_mapping_attributes:
+            continue
+
+        attribute = f'V{len(attributes):03d}'
+        lookup = {
+                'Fn::FindInMap': [
+                    compact_mapping,
+                    name,
+                    attribute,
+                    ]
+                }
+
+        inline = count * len(value)
+        mapped = count * len(json.dumps(lookup)) + \
+            len(json.dumps({attribute: None})) + len(value)
+        if mapped < inline:
+            attributes[attribute] = json.loads(value)
+            lookups[(name, value)] = lookup
+            saved[name] += inline - mapped
+
+    # the entries of the names and of the mapping itself have to pay too
+    for name, attributes in mapping.items():
+        saved[name] -= len(json.dumps({name: dict()}))
+        if saved[name] <= 0:
+            attributes.clear()
+            saved[name] = 0
+    if sum(saved.values()) <= len(json.dumps({compact_mapping: dict()})):
+        mapping.clear()
+
+    lookups = dict([
+        ((name, value), lookup)
+        for (name, value), lookup
+        in lookups.items()
+        if mapping.get(name)
+        ])
+
+    if lookups:
+        for resource in fragment['Resources'].values():
+            properties = resource['Properties']
+            for parent, key, name in list(compact_candidates(properties)):
+                lookup = lookups.get((name, json.dumps(parent[key])))
+                if lookup is not None:
+                    parent[key] = deepcopy(lookup)
+
+        fragment['Mappings'][compact_mapping] = {
+                name: attributes
+                for name, attributes
+                in mapping.items()
+                if attributes
+                }
+
+    after = len(json.dumps(fragment, default=str))
+    logger.info(f'fragment compacted from {before} to {after} bytes')
+    utilities.metrics.count('FragmentBytes', after, 'Bytes')
+    utilities.metrics.count('FragmentBytesSaved', before - after, 'Bytes')
+
+    return before - after
+
+
 def clean_zone_names(zones):
     return set([
         zone if zone.endswith('.') else zone + '.'
@@ -380,10 +813,27 @@ def target_endpoint_ips(parm):
         raise RuntimeError('Internal: kind should be AwsZones|OnPremZones')
 
 
+def exported_vpcs(parm):
+    if parm.kind != 'OnPremZones':
+        return list()  # do not ever associate hosted zones
+
+    return [
+            export['Value']
+            for export
+            in utilities.boto3_call('list_exports', cache=True)
+            if utilities.is_exported_vpc(export)
+            and export['Value'] not in parm.region_data['VpcDni']
+            ]
+
+
 def create_template(event, context):
     '''
     Assuming the correct template; do not attempt to recover.
     '''
+    # listings are cached within this invocation only: a warm container
+    # must not plan a deploy from the state before the previous one
+    utilities.invalidate_cache()
+
     parm = Namespace(
             event=event,
             region_name=event['region'],
@@ -405,46 +855,118 @@ def create_template(event, context):
             ]:
         parm.__setattr__(v, event['templateParameterValues'][k])
 
+    # number of independent DependsOn chains; optional, 1 is fully serial
+    parm.parallel_lanes = int(event['templateParameterValues'].get(
+        'MaxParallelLanes', 1))
+    if parm.parallel_lanes < 1:
+        raise ValueError(f'MaxParallelLanes should be positive:'
+                         f' {parm.parallel_lanes}')
+
+    # any new value re-runs all auto-associations (manual resync)
+    parm.force_refresh = event['templateParameterValues'].get(
+            'ForceRefresh', '')
+
+    # `Resource`: one association resource per zone and VPC, `Bulk`: one
+    # CFNAutoAssociate custom resource per VPC
+    parm.vpc_association_mode = event['templateParameterValues'].get(
+            'VpcAssociationMode', 'Resource')
+    if parm.vpc_association_mode not in ['Resource', 'Bulk']:
+        raise ValueError(f'VpcAssociationMode should be Resource or Bulk:'
+                         f' {parm.vpc_association_mode}')
+
+    # `Principal`: one auto-associate custom resource per share and
+    # principal, `Share`: one per share for all of its principals
+    parm.auto_associate_scope = event['templateParameterValues'].get(
+            'AutoAssociateScope', 'Principal')
+    if parm.auto_associate_scope not in ['Principal', 'Share']:
+        raise ValueError(f'AutoAssociateScope should be Principal or Share:'
+                         f' {parm.auto_associate_scope}')
+
+    # common tags come from the stack tags instead of every resource
+    parm.stack_level_tags = str(event['templateParameterValues'].get(
+        'StackLevelTags', 'false')).lower() == 'true'
+
+    # zones are split into `ShardCount` stacks, this one is `ShardIndex`
+    parm.shard_count = int(event['templateParameterValues'].get(
+        'ShardCount', 1))
+    parm.shard_index = int(event['templateParameterValues'].get(
+        'ShardIndex', 0))
+    if not 0 <= parm.shard_index < parm.shard_count:
+        raise ValueError(f'ShardIndex should be in [0, ShardCount):'
+                         f' {parm.shard_index}/{parm.shard_count}')
+
     # prefix for the resources exported by this stack (eg. RAM shares)
     parm.share_prefix = \
         f'wex-{parm.kind}-zones-share-{parm.target_env}'.lower()
+    if parm.shard_count > 1:
+        parm.share_prefix += f'-s{parm.shard_index:02d}'
 
     # list of principals to share rules to
     parm.principals = sorted(set(parm.wex['Accounts']) -
                              set([parm.event['accountId']]))
 
-    # cache target endpoint ips, they are common for all the rules
-    parm.target_endpoint_ips = target_endpoint_ips(parm)
+    if parm.kind == 'OnPremZones':
+        if 'VpcDni' not in parm.region_data:
+            parm.region_data['VpcDni'] = list()
+
+    # independent listings; macro takes as long as the slowest of them
+    # target endpoint ips are common for all the rules
+    parm.target_endpoint_ips, parm.vpcs, _ = utilities.fan_out([
+        partial(target_endpoint_ips, parm),
+        partial(exported_vpcs, parm),
+        partial(load_existing_data, parm),
+        ])
 
     parm.resources = dict()  # acts as a symlink to event[..]
     event['fragment']['Resources'] = parm.resources
 
-    if parm.kind == 'OnPremZones':
-        if 'VpcDni' not in parm.region_data:
-            parm.region_data['VpcDni'] = set()
-
-        parm.vpcs = [
-                export['Value']
-                for export
-                in utilities.boto3_call('list_exports')
-                if utilities.is_exported_vpc(export)
-                and export['Value'] not in parm.region_data['VpcDni']
-                ]
-    else:
-        parm.vpcs = list()  # do not ever associate hosted zones
+    parm.index = {
+            'Type': dict(),
+            'DomainName': dict(),
+            }
+
+    # existing associations keep their owner: switching VpcAssociationMode
+    # applies to new (VPC, zone) pairs and never drops or duplicates one
+    load_association_owners(parm)
+    bulk_rule_ids = dict([
+        (vpc_id, list())
+        for vpc_id
+        in parm.vpcs
+        ])
 
     for zone in clean_zone_names(parm.wex[parm.kind]):
+        if zone_shard(zone, parm.shard_count) != parm.shard_index:
+            continue  # belongs to another shard
+
         rule_id, rule_data = resource_rule(parm, zone)
-        parm.resources[rule_id] = rule_data
+        add_resource(parm, rule_id, rule_data)
 
         # Associate to all locally exported VPCs
         # (except the ones listed in the DNI section)
         for vpc_id in parm.vpcs:
-            rule_assoc_id, rule_assoc_data = \
-                    resource_rule_association(parm, vpc_id, rule_id)
-            parm.resources[rule_assoc_id] = rule_assoc_data
-
-    load_existing_data(parm)
+            if parm.association_owners.get(
+                    (vpc_id, zone), parm.vpc_association_mode) == 'Bulk':
+                bulk_rule_ids[vpc_id].append(rule_id)
+                continue  # one custom resource per VPC below
+
+            rule_assoc_id, rule_assoc_data = resource_rule_association(
+                    parm, vpc_id, rule_id)
+            add_resource(parm, rule_assoc_id, rule_assoc_data)
+
+    # one VPC at a time, they share the local API limits
+    throttle = None
+    for vpc_id in parm.vpcs:
+        if parm.vpc_association_mode != 'Bulk' and not bulk_rule_ids[vpc_id]:
+            continue  # no association of this VPC is made in bulk
+
+        vpc_assoc_id, vpc_assoc_data = resource_vpc_associate(
+                parm, vpc_id, bulk_rule_ids[vpc_id])
+        if throttle is not None:
+            vpc_assoc_data['DependsOn'] = [
+                    throttle
+                    ]
+        throttle = vpc_assoc_id
+        add_resource(parm, vpc_assoc_id, vpc_assoc_data)
 
     # load existing infra; note some keys might be missing, like '1' here:
     # {
@@ -459,23 +981,22 @@ def create_template(event, context):
     #   ...
     # }
     infra_pre = join_resources(parm)
-    infra_post = pre_to_post(infra_pre, set(
-        [
-            resource['Properties']['DomainName']
-            for resource
-            in parm.resources.values()
-            if resource['Type'] == 'AWS::Route53Resolver::ResolverRule'
-            ]
-        ),
-        parm.max_rules)
+    infra_post = pre_to_post(infra_pre,
+                             set(parm.index['DomainName']),
+                             parm.max_rules)
 
     principal_pre = join_principals(parm)
     principal_post = pre_to_post(principal_pre, deepcopy(
         parm.principals
         ),
         parm.max_rules)
+    parm.infra_post, parm.principal_post = infra_post, principal_post
 
-    throttle = None  # chain resources together to avoid API throttling
+    # chain resources together to avoid API throttling; shares (with their
+    # auto-associations) are dealt round-robin into independent lanes,
+    # CloudFormation works on the lanes side by side
+    lanes = [None] * parm.parallel_lanes
+    lane = 0
     for principal_slot, principal_list in principal_post.items():
         for zone_slot, zone_list in infra_post.items():
             share_id, share_data = \
@@ -485,23 +1006,46 @@ def create_template(event, context):
                                    principal_slot,
                                    principal_list)
             # add a twist, make 'em depend one from the other
+            throttle = lanes[lane]
             if throttle is not None:
                 share_data['DependsOn'] = [
                         throttle
                         ]
             throttle = share_id
-            parm.resources[share_id] = share_data
-
-            for principal in principal_list:
-                saa_id, saa_data = \
-                        resource_auto_associate(parm, share_id, principal)
+            add_resource(parm, share_id, share_data)
+
+            if parm.auto_associate_scope == 'Share':
+                auto_associates = [
+                        resource_share_auto_associate(parm,
+                                                      share_id,
+                                                      zone_list,
+                                                      principal_list)
+                        ]
+            else:
+                auto_associates = [
+                        resource_auto_associate(parm,
+                                                share_id,
+                                                zone_list,
+                                                principal)
+                        for principal
+                        in principal_list
+                        ]
 
+            for saa_id, saa_data in auto_associates:
                 saa_data['DependsOn'] = [
                         throttle
                         ]
                 throttle = saa_id
 
-                parm.resources[saa_id] = saa_data
+                add_resource(parm, saa_id, saa_data)
+
+            lanes[lane] = throttle
+            lane = (lane + 1) % len(lanes)
+
+    utilities.metrics.resources(parm.resources)
+
+    compact_fragment(parm, event['fragment'])
+    check_limits(parm, event['fragment'])
 
     return {
             'requestId': event['requestId'],
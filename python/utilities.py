@@ -1,14 +1,22 @@
 #!/usr/bin/env python3
 import boto3
+from botocore import xform_name
 from botocore.config import Config
+from botocore.exceptions import ClientError
+from datetime import datetime, timedelta, timezone
 import json
 import hashlib
 import logging
+import os
 import re
+import threading
 import urllib3
 
-from random import uniform
-from time import sleep
+from argparse import Namespace
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from functools import partial
+from time import monotonic, sleep, time
 
 exported = {
         'endpoint_inbound': (
@@ -84,6 +92,126 @@ boto3_map = {
             ),
         }
 
+# largest page each listing accepts; fewer round trips on busy accounts
+boto3_page_sizes = {
+        'list_resolver_rule_associations': ('MaxResults', 100),
+        'list_resolver_endpoint_ip_addresses': ('MaxResults', 100),
+        'list_resolver_rules': ('MaxResults', 100),
+        'list_tags_for_resource': ('MaxResults', 100),
+        'list_resources': ('maxResults', 500),
+        'list_principals': ('maxResults', 500),
+        'get_resource_shares': ('maxResults', 500),
+        }
+
+# `boto3_call(.., filters=..)` fields the services filter on natively:
+# item field -> (request parameter, most values it takes); route53resolver
+# `Filters` take a single value, `tag:<Key>` fields map to RAM `tagFilters`
+boto3_filters = {
+        'list_resources': {
+            'resourceShareArn': ('resourceShareArns', 100),
+            'type': ('resourceType', 1),
+            },
+        'list_principals': {
+            'resourceShareArn': ('resourceShareArns', 100),
+            },
+        'get_resource_shares': {
+            'status': ('resourceShareStatus', 1),
+            'name': ('name', 1),
+            'tag:': ('tagFilters', 100),
+            },
+        'list_resolver_rules': dict([
+            (field, ('Filters', 1))
+            for field
+            in [
+                'CreatorRequestId',
+                'DomainName',
+                'Name',
+                'ResolverEndpointId',
+                'Status',
+                ]
+            ]),
+        'list_resolver_rule_associations': dict([
+            (field, ('Filters', 1))
+            for field
+            in [
+                'Name',
+                'ResolverRuleId',
+                'Status',
+                'VPCId',
+                ]
+            ]),
+        }
+
+boto3_config = Config(
+        retries=dict(
+            max_attempts=10
+            )
+        )
+
+# name of the rule associations made by CFNAutoAssociate; CloudFormation
+# ResolverRuleAssociation resources have none
+auto_association_name = 'Do not remove manually'
+
+# sessions and clients survive between warm Lambda invocations; keyed by
+# (region, access key id), then by service name
+boto3_sessions = dict()
+boto3_sessions_lock = threading.Lock()
+
+# evict assumed role sessions a bit before the credentials expire
+credentials_margin = timedelta(minutes=5)
+
+# access tokens by role ARN; warm containers skip the STS round trip
+assumed_roles = dict()
+assumed_roles_lock = threading.Lock()
+
+# error codes botocore reports when the API is throttling us
+throttling_errors = set([
+        'Throttling',
+        'ThrottlingException',
+        'ThrottledException',
+        'TooManyRequestsException',
+        'RequestLimitExceeded',
+        ])
+
+# extra attempts once botocore itself gave up on a throttled call
+throttling_retries = 5
+
+# read-through cache for listings, see `boto3_call(.., cache=True)`
+boto3_cache_ttl = float(os.environ.get('BOTO3_CACHE_TTL', '60'))
+
+boto3_cache = dict()
+boto3_cache_inflight = dict()
+boto3_cache_lock = threading.Lock()
+boto3_cache_counters = {
+        'hits': 0,
+        'misses': 0,
+        'coalesced': 0,
+        'invalidations': 0,
+        }
+
+# mutating calls and the cached listings they make stale
+boto3_invalidates = {
+        'associate_resolver_rule': [
+            'list_resolver_rule_associations',
+            ],
+        'disassociate_resolver_rule': [
+            'list_resolver_rule_associations',
+            ],
+        }
+
+# CloudWatch Embedded Metric Format; `METRICS_SINK` redirects to a file
+metrics_namespace = os.environ.get('METRICS_NAMESPACE', 'Wex/Route53')
+metrics_sink = os.environ.get('METRICS_SINK')
+
+# upper bound for `fan_out` threads
+fan_out_workers = 8
+
+# shared by all callers in the process; keyed by (service, method,
+# identity), the ARN of assumed roles (None locally): accounts are
+# throttled independently, and keep their state when credentials rotate
+rate_limiters = dict()
+rate_limiters_lock = threading.Lock()
+
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
@@ -95,6 +223,17 @@ def mk_id(args):
     return args[0] + digest.hexdigest()[-17:].capitalize()
 
 
+def mk_digest(args):
+    '''
+    Stable content hash; use it to make CFN update a resource only when
+    the inputs actually change
+    '''
+    digest = hashlib.blake2b(digest_size=16)
+    for arg in args:
+        digest.update(bytes(json.dumps(arg, sort_keys=True), 'utf-8'))
+    return digest.hexdigest()
+
+
 def import_value(event, wex, resource, region=None):
     if region is None:
         region = re.sub('(.).*?-', '\\1', event['region'])
@@ -179,30 +318,580 @@ def send_response(status, reason, event, context):
     logger.debug(f"Response status code: {response.status}")
 
 
-def boto3_call(method, access_token=dict(), request=dict()):
-    variations = ['NextToken', 'nextToken']
+class Metrics:
+    '''
+    Per-invocation counters and latencies; `flush` writes them as CloudWatch
+    Embedded Metric Format JSON lines to `sink` (stdout, ie. the log group,
+    unless `METRICS_SINK` names a file or the sink is replaced).
+    '''
+    max_metrics = 100  # EMF limit per document
+    max_values = 100  # EMF limit per metric
+
+    def __init__(self, sink=None):
+        self.sink = sink
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self, handler=None):
+        with self.lock:
+            self.handler = handler
+            self.counters = dict()
+            self.units = dict()
+            self.latencies = dict()
+
+    def count(self, name, value=1, unit='Count'):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+            self.units[name] = unit
+
+    def latency(self, name, seconds):
+        with self.lock:
+            self.latencies.setdefault(name, list()).append(seconds * 1000)
+
+    def resources(self, resources):
+        for resource in resources.values():
+            self.count('Resources.' + resource['Type'].split('::')[-1])
+
+    def summary(self):
+        '''
+        Counters and p50/p90/p99/max latencies (ms) computed locally
+        '''
+        with self.lock:
+            value = dict(self.counters)
+
+            for name, samples in self.latencies.items():
+                samples = sorted(samples)
+                for label, rank in [
+                        ('P50', 0.50),
+                        ('P90', 0.90),
+                        ('P99', 0.99),
+                        ('Max', 1.00),
+                        ]:
+                    value[f'{name}{label}'] = \
+                        samples[max(0, int(rank * len(samples) + 0.5) - 1)]
+
+        return value
+
+    def write(self, line):
+        if self.sink is not None:
+            self.sink(line)
+        elif metrics_sink:
+            with open(metrics_sink, 'a') as f:
+                f.write(line + '\n')
+        else:
+            print(line)
+
+    def flush(self):
+        with self.lock:
+            rounds = [
+                    [
+                        (name, value, self.units[name])
+                        for name, value
+                        in sorted(self.counters.items())
+                        ],
+                    ]
 
-    config = Config(
-            retries=dict(
-                max_attempts=10
-                )
+            # a metric shows up once per document: every `max_values`
+            # samples go to the next round of documents, none are dropped
+            for name, samples in sorted(self.latencies.items()):
+                for batch, index in enumerate(
+                        range(0, len(samples), self.max_values)):
+                    if batch == len(rounds):
+                        rounds.append(list())
+                    rounds[batch].append((
+                        name,
+                        samples[index:index + self.max_values],
+                        'Milliseconds',
+                        ))
+            handler = self.handler
+
+        chunks = [
+                values[index:index + self.max_metrics]
+                for values
+                in rounds
+                for index
+                in range(0, len(values), self.max_metrics)
+                ]
+
+        for chunk in chunks:
+            document = {
+                    '_aws': {
+                        'Timestamp': int(time() * 1000),
+                        'CloudWatchMetrics': [
+                            {
+                                'Namespace': metrics_namespace,
+                                'Dimensions': [
+                                    [
+                                        'Handler',
+                                        ],
+                                    ],
+                                'Metrics': [
+                                    {
+                                        'Name': name,
+                                        'Unit': unit,
+                                        }
+                                    for name, _, unit
+                                    in chunk
+                                    ],
+                                },
+                            ],
+                        },
+                    'Handler': handler,
+                    }
+            document.update([(name, value) for name, value, _ in chunk])
+
+            self.write(json.dumps(document))
+
+    @contextmanager
+    def invocation(self, handler):
+        '''
+        Wraps a Lambda handler: resets, times and flushes, even on errors
+        '''
+        self.reset(handler)
+        started = monotonic()
+        try:
+            yield self
+        finally:
+            self.latency('HandlerTime', monotonic() - started)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f'Unable to write metrics: {e}')
+
+
+metrics = Metrics()
+
+
+class RateLimiter:
+    '''
+    Token bucket with AIMD rate control: run at `max_rate` until throttled,
+    multiply the rate by `decrease` on throttling, add `increase` back
+    on every successful call.
+    '''
+    def __init__(self, max_rate=100.0, min_rate=0.2,
+                 increase=1.0, decrease=0.5):
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.increase = increase
+        self.decrease = decrease
+
+        self.rate = max_rate
+        self.tokens = max_rate
+        self.updated = monotonic()
+
+        self.calls = 0
+        self.throttles = 0
+
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = monotonic()
+            self.tokens = min(max(1.0, self.rate),
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+            # reserve the token now, sleep outside of the lock
+            self.tokens -= 1
+            self.calls += 1
+            delay = max(0.0, -self.tokens / self.rate)
+
+        if delay:
+            sleep(delay)
+
+    def success(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def throttle(self):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            self.tokens = min(self.tokens, 0.0)
+            self.throttles += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                    'rate': self.rate,
+                    'calls': self.calls,
+                    'throttles': self.throttles,
+                    }
+
+
+def rate_limiter(service, method, identity=None):
+    with rate_limiters_lock:
+        if (service, method, identity) not in rate_limiters:
+            rate_limiters[(service, method, identity)] = RateLimiter()
+        return rate_limiters[(service, method, identity)]
+
+
+def rate_limiter_stats():
+    with rate_limiters_lock:
+        limiters = list(rate_limiters.items())
+
+    # do not log role ARNs or access key ids
+    return dict([
+        (
+            f'{service}:{method}' +
+            (f'@{mk_digest([identity])[:8]}' if identity else ''),
+            limiter.stats(),
             )
+        for (service, method, identity), limiter
+        in limiters
+        ])
+
+
+def is_throttling(error):
+    return isinstance(error, ClientError) and \
+        error.response.get('Error', {}).get('Code') in throttling_errors
+
+
+def limiter_identity(access_token):
+    '''
+    Role ARN of assumed roles, access key id of other credentials
+    '''
+    return access_token.get('role_arn',
+                            access_token.get('aws_access_key_id'))
+
+
+def on_needs_retry(identity, **kwargs):
+    '''
+    botocore retries throttled calls on its own; slow the limiter down
+    every time it does so. `identity` is bound per pooled client.
+    '''
+    response, operation = kwargs.get('response'), kwargs.get('operation')
+
+    if response is None or operation is None:
+        return None
+
+    if response[1].get('Error', {}).get('Code') in throttling_errors:
+        rate_limiter(operation.service_model.service_name,
+                     xform_name(operation.name),
+                     identity).throttle()
+        metrics.count(f'{xform_name(operation.name)}.Throttles')
+
+    return None
+
+
+def evict_expired_sessions():
+    now = datetime.now(timezone.utc)
+
+    for key in [
+            key
+            for key, pooled
+            in boto3_sessions.items()
+            if pooled.expiration is not None
+            and pooled.expiration - credentials_margin <= now
+            ]:
+        logger.debug(f'Evicting expired session: {key}')
+        del boto3_sessions[key]
+
+
+def boto3_credentials(access_token):
+    '''
+    Returns boto3 Session arguments and the (region, access key id) identity
+    '''
+    credentials = dict([
+        (k, v)
+        for k, v
+        in access_token.items()
+        if k not in ['expiration', 'role_arn']
+        ])
+
+    if 'region_name' not in credentials:
+        credentials['region_name'] = os.environ.get(
+                'AWS_REGION',
+                os.environ.get('AWS_DEFAULT_REGION'))
+
+    return (
+            credentials,
+            (
+                credentials['region_name'],
+                credentials.get('aws_access_key_id'),
+                ),
+            )
+
+
+def boto3_client(service, access_token=dict()):
+    '''
+    Pooled client; `access_token` may carry `expiration` (datetime),
+    `role_arn` and `region_name` next to the usual boto3 credentials.
+    '''
+    credentials, key = boto3_credentials(access_token)
+
+    with boto3_sessions_lock:
+        evict_expired_sessions()
+
+        if key not in boto3_sessions:
+            boto3_sessions[key] = Namespace(
+                    session=boto3.session.Session(**credentials),
+                    expiration=access_token.get('expiration'),
+                    clients=dict(),
+                    )
+
+        pooled = boto3_sessions[key]
+
+        if service not in pooled.clients:
+            pooled.clients[service] = pooled.session.client(
+                    service,
+                    config=boto3_config)
+            pooled.clients[service].meta.events.register_first(
+                    'needs-retry',
+                    partial(on_needs_retry, limiter_identity(access_token)))
+
+        return pooled.clients[service]
+
+
+def assume_role(role_arn, session_name='cross_account_lambda'):
+    '''
+    Access token for `role_arn`, reused until `credentials_margin` before
+    it expires; the same credentials map to the same pooled clients.
+    '''
+    with assumed_roles_lock:
+        access_token = assumed_roles.get(role_arn)
+
+    if access_token is not None and \
+            access_token['expiration'] - credentials_margin > \
+            datetime.now(timezone.utc):
+        metrics.count('assume_role.CacheHits')
+        return dict(access_token)
+
+    peer = boto3_client('sts').assume_role(RoleArn=role_arn,
+                                           RoleSessionName=session_name)
+    peer = peer['Credentials']
+    metrics.count('assume_role.Calls')
+
+    # `expiration` and `role_arn` are not passed to boto3; the first evicts
+    # pooled clients, the second keys the rate limiters across rotations
+    access_token = {
+            'aws_access_key_id': peer['AccessKeyId'],
+            'aws_secret_access_key': peer['SecretAccessKey'],
+            'aws_session_token': peer['SessionToken'],
+            'expiration': peer['Expiration'],
+            'role_arn': role_arn,
+            }
 
-    client = boto3.client(boto3_map[method][0],
-                          **access_token,
-                          config=config)
+    with assumed_roles_lock:
+        assumed_roles[role_arn] = access_token
 
-    value = list()
+    return dict(access_token)
 
-    for variation in variations:
-        if variation in request:
-            del request[variation]
+
+def cache_key(method, access_token, request):
+    return (
+            method,
+            boto3_credentials(access_token)[1],
+            json.dumps(request, sort_keys=True, default=str),
+            )
+
+
+def cache_lookup(key):
+    '''
+    Returns a copy of the cached value or None; call with the lock held
+    '''
+    if key in boto3_cache:
+        expires, value = boto3_cache[key]
+        if expires > monotonic():
+            boto3_cache_counters['hits'] += 1
+            metrics.count(f'{key[0]}.CacheHits')
+            return list(value)
+        del boto3_cache[key]
+    return None
+
+
+def invalidate_cache(methods=None, access_token=None):
+    '''
+    Drops cached listings for `methods` (all if None) made with
+    `access_token` (any credentials if None).
+    '''
+    identity = None if access_token is None \
+        else boto3_credentials(access_token)[1]
+
+    with boto3_cache_lock:
+        for key in [
+                key
+                for key
+                in boto3_cache
+                if (methods is None or key[0] in methods)
+                and (identity is None or key[1] == identity)
+                ]:
+            del boto3_cache[key]
+            boto3_cache_counters['invalidations'] += 1
+
+        # results of calls in flight are stale too; don't store them
+        for key in boto3_cache_inflight:
+            if (methods is None or key[0] in methods) \
+                    and (identity is None or key[1] == identity):
+                boto3_cache_inflight[key].stale = True
+
+
+def cache_info():
+    with boto3_cache_lock:
+        return dict(boto3_cache_counters, entries=len(boto3_cache))
+
+
+def cached_call(method, access_token, request):
+    '''
+    Yields the items as the pages arrive and stores the listing once read
+    to the end; a caller stopping early leaves nothing behind. Single-flight:
+    concurrent identical listings wait for the first one.
+    '''
+    key = cache_key(method, access_token, request)
 
     while True:
-        sleep(uniform(1, 3))
-        response = getattr(client, method)(**request)
+        with boto3_cache_lock:
+            value = cache_lookup(key)
+            inflight = boto3_cache_inflight.get(key)
+            if value is None and inflight is None:
+                inflight = Namespace(done=threading.Event(), stale=False,
+                                     owner=threading.get_ident())
+                boto3_cache_inflight[key] = inflight
+                boto3_cache_counters['misses'] += 1
+                break
+            if value is None:
+                boto3_cache_counters['coalesced'] += 1
+
+        if value is not None:
+            yield from value
+            return
 
-        value += response[boto3_map[method][1]]
+        if inflight.owner == threading.get_ident():
+            # nested in our own listing: waiting would never end
+            yield from iter_boto3(method, access_token, request)
+            return
+
+        # somebody else is fetching; re-check once it's done (or stopped)
+        inflight.done.wait()
+
+    try:
+        value = list()
+        for item in iter_boto3(method, access_token, request):
+            value.append(item)
+            yield item
+
+        with boto3_cache_lock:
+            if not inflight.stale:
+                boto3_cache[key] = (monotonic() + boto3_cache_ttl, value)
+    finally:
+        with boto3_cache_lock:
+            del boto3_cache_inflight[key]
+        inflight.done.set()
+
+
+def filter_values(value):
+    if isinstance(value, (list, set, frozenset, tuple)):
+        return sorted(set(value))
+    return [value]
+
+
+def push_down_filters(method, request, filters):
+    '''
+    Copy of `request` with the `filters` the service supports natively
+    '''
+    request = dict(request)
+
+    for field, value in filters.items():
+        native = boto3_filters.get(method, dict()).get(
+                'tag:' if field.startswith('tag:') else field)
+        values = filter_values(value)
+        if native is None or len(values) > native[1]:
+            continue  # client side only
+
+        parameter = native[0]
+        if parameter == 'Filters':
+            request['Filters'] = request.get('Filters', list()) + [
+                    {
+                        'Name': field,
+                        'Values': values,
+                        },
+                    ]
+        elif parameter == 'tagFilters':
+            request['tagFilters'] = request.get('tagFilters', list()) + [
+                    {
+                        'tagKey': field[len('tag:'):],
+                        'tagValues': values,
+                        },
+                    ]
+        elif native[1] == 1:
+            request[parameter] = values[0]
+        else:
+            request[parameter] = values
+
+    return request
+
+
+def filter_match(item, filters):
+    '''
+    Client side `filters`: {field: value or [values]}, `tag:<Key>` matches
+    the RAM style `tags`
+    '''
+    for field, value in filters.items():
+        values = filter_values(value)
+
+        if field.startswith('tag:'):
+            if not any([
+                    tag['key'] == field[len('tag:'):]
+                    and tag['value'] in values
+                    for tag
+                    in item.get('tags', list())
+                    ]):
+                return False
+
+        elif item.get(field) not in values:
+            return False
+
+    return True
+
+
+def iter_boto3(method, access_token=dict(), request=dict(), cache=False):
+    '''
+    Yields items page by page; stop iterating to stop paginating.
+    With `cache` the listing goes through the read-through cache: stored
+    when read to the end, and shared with concurrent identical listings.
+    '''
+    variations = ['NextToken', 'nextToken']
+
+    if cache:
+        yield from cached_call(method, access_token, request)
+        return
+
+    client = boto3_client(boto3_map[method][0], access_token)
+    limiter = rate_limiter(boto3_map[method][0], method,
+                           limiter_identity(access_token))
+
+    request = dict([
+        (k, v)
+        for k, v
+        in request.items()
+        if k not in variations
+        ])
+
+    if method in boto3_page_sizes:
+        request.setdefault(*boto3_page_sizes[method])
+
+    metrics.count(f'{method}.Calls')
+
+    while True:
+        for attempt in range(throttling_retries + 1):
+            limiter.acquire()
+            started = monotonic()
+            try:
+                response = getattr(client, method)(**request)
+                break
+            except ClientError as e:
+                if not is_throttling(e) or attempt == throttling_retries:
+                    raise
+                limiter.throttle()
+                metrics.count(f'{method}.Throttles')
+        limiter.success()
+
+        metrics.count(f'{method}.Pages')
+        metrics.latency(f'{method}.Latency', monotonic() - started)
+
+        if method in boto3_invalidates:
+            invalidate_cache(boto3_invalidates[method], access_token)
+
+        yield from response[boto3_map[method][1]]
 
         next_token = None
 
@@ -217,7 +906,54 @@ def boto3_call(method, access_token=dict(), request=dict()):
 
         request[next_token] = response[next_token]
 
-    return value
+
+def boto3_call(method, access_token=dict(), request=dict(), cache=False,
+               filters=dict()):
+    '''
+    Returns all items; with `cache` goes through the read-through cache.
+    `filters` ({item field: value or [values]}) go to the service where it
+    can filter on them (see `boto3_filters`) and are always re-checked on
+    the client side.
+    '''
+    request = push_down_filters(method, request, filters)
+
+    if cache:
+        items = list(cached_call(method, access_token, request))
+    else:
+        items = list(iter_boto3(method, access_token, request))
+
+    if not filters:
+        return items
+
+    return [
+            item
+            for item
+            in items
+            if filter_match(item, filters)
+            ]
+
+
+def fan_out(calls, max_workers=fan_out_workers):
+    '''
+    Runs independent callables on a bounded thread pool; returns results in
+    the order of `calls`. Waits for all of them, then re-raises the error
+    of the first failed call (in order, not in time).
+    '''
+    calls = list(calls)
+
+    if not calls:
+        return list()
+
+    with ThreadPoolExecutor(
+            max_workers=max(1, min(max_workers, len(calls)))) as executor:
+        futures = [executor.submit(call) for call in calls]
+        wait(futures)
+
+    for future in futures:
+        if future.exception() is not None:
+            raise future.exception()
+
+    return [future.result() for future in futures]
 
 
 def is_exported_vpc(export):
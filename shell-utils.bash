@@ -140,11 +140,16 @@ while (( $# )); do
             readonly static_parameters="$2"
             shift 2
             ;;
+        -s|--shards)
+            readonly shards="$2"
+            shift 2
+            ;;
         *)
             echo "Usage: $0 -a|--aws-account account"
             echo "          -r|--region region"
             echo "          -l|--lambda-version version (eg. v01)"
             echo "          -t|--target-environment tag (eg. prod)"
+            echo "          -s|--shards count (zones stacks; default 1)"
             exit 1
             ;;
     esac
@@ -153,6 +158,9 @@ done
 [[ ${static_parameters:-null} = 'null' ]] && \
     static_parameters='static_parameters.json'
 
+[[ ${shards:-null} = 'null' ]] && \
+    shards=1
+
 if [[ $region == 'global' ]]; then
     readonly short_region='glb'
     readonly upper_region='GLB'
@@ -175,6 +183,7 @@ readonly \
     role_utilities \
     role_satellite \
     lambda_version \
+    shards \
     json_template \
     short_region \
     upper_region \
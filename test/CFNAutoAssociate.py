@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+'''
+Times CFNAutoAssociate against FakeAws, eg.
+
+    ./test/CFNAutoAssociate.py                                # one principal
+    ./test/CFNAutoAssociate.py -s -p 5 --throttle-rate 0.2    # Share scope
+    ./test/CFNAutoAssociate.py -b                             # Bulk, per VPC
+    ./test/CFNAutoAssociate.py -z 2000 -t 6                   # continuations
+'''
+import argparse
+import json
+import sys
+import tempfile
+import uuid
+
+from time import monotonic
+
+sys.path.insert(1, '.')
+sys.path.insert(1, './python')
+
+from python import CFNAutoAssociate  # noqa: E402
+from FakeAws import FakeAws  # noqa: E402
+
+import utilities  # noqa: E402
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-z", "--zones", type=int,
+                    help="Rules in the share", default=50)
+parser.add_argument("-v", "--vpcs", type=int,
+                    help="Exported VPCs in the principal account", default=3)
+parser.add_argument("--latency", type=float,
+                    help="Seconds per API call", default=0.0)
+parser.add_argument("--throttle-rate", type=float,
+                    help="ThrottlingException probability", default=0.0)
+parser.add_argument("-p", "--principals", type=int,
+                    help="Principal accounts of the share", default=1)
+parser.add_argument("-s", "--share", action='store_true',
+                    help="AutoAssociateScope Share: one invocation for all "
+                    "the principals", default=False)
+parser.add_argument("-t", "--timeout", type=float,
+                    help="Lambda timeout in seconds; long syncs continue in "
+                    "new invocations", default=None)
+parser.add_argument("-b", "--bulk", action='store_true',
+                    help="Bulk VpcAssociationMode: one local VPC, "
+                    "create/update/delete", default=False)
+args = parser.parse_args()
+
+owner = '229349022034'
+principals = [
+        f'{544308222195 + i:012d}'
+        for i
+        in range(args.principals)
+        ]
+
+fake = FakeAws(account_id=owner,
+               zones=[f'zone{i:05d}.example.' for i in range(args.zones)],
+               shares=1,
+               max_rules=args.zones,
+               principals=principals,
+               remote_vpcs=args.vpcs,
+               latency=args.latency,
+               throttle_rate=args.throttle_rate).install()
+
+lines = list()
+utilities.metrics.sink = lines.append
+
+# checkpoints of this run only
+store = CFNAutoAssociate.FileCheckpoints(tempfile.mkdtemp())
+if args.timeout is not None:
+    CFNAutoAssociate.deadline_margin = args.timeout / 10
+
+
+class FakeContext:
+    invoked_function_arn = \
+        f'arn:aws:lambda:{fake.region}:{owner}:function:CFNAutoAssociate'
+
+    def __init__(self, timeout):
+        self.deadline = monotonic() + timeout
+
+    def get_remaining_time_in_millis(self):
+        return int((self.deadline - monotonic()) * 1000)
+
+
+def run(event):
+    '''
+    Handler minus the CFN response; returns the number of invocations
+    '''
+    pending = [
+            dict(event,
+                 StackId='test',
+                 RequestId=f'{uuid.uuid4()}',
+                 LogicalResourceId='crTest'),
+            ]
+    invocations = 0
+
+    while pending:
+        event = pending.pop(0)
+        context = None
+        if args.timeout is not None:
+            context = FakeContext(args.timeout)
+
+        checkpoint = CFNAutoAssociate.Checkpoint(event, context, store)
+        invocations += 1
+        if CFNAutoAssociate.process(event, context, checkpoint):
+            checkpoint.clear()
+
+        pending += fake.invocations
+        fake.invocations.clear()
+
+    return invocations
+
+
+if args.bulk:
+    vpc = f'vpc-{owner}00000'
+    rule_ids = sorted(fake.accounts[owner].rules)
+    event = {
+            'RequestType': 'Create',
+            'ResourceProperties': {
+                'VpcId': vpc,
+                'RuleIds': rule_ids,
+                },
+            }
+
+    started = monotonic()
+    steps = dict()
+    with utilities.metrics.invocation('CFNAutoAssociate'):
+        CFNAutoAssociate.sync_vpc_associations(event, None)
+        steps['Create'] = len(fake.accounts[owner].associations)
+
+        # a zone removed from the template
+        event = dict(event,
+                     RequestType='Update',
+                     OldResourceProperties=event['ResourceProperties'],
+                     ResourceProperties=dict(event['ResourceProperties'],
+                                             RuleIds=rule_ids[1:]))
+        CFNAutoAssociate.sync_vpc_associations(event, None)
+        steps['Update'] = len(fake.accounts[owner].associations)
+
+        event = dict(event, RequestType='Delete')
+        event.pop('OldResourceProperties')
+        CFNAutoAssociate.sync_vpc_associations(event, None)
+        steps['Delete'] = len(fake.accounts[owner].associations)
+
+    print(json.dumps({
+        'seconds': monotonic() - started,
+        'associations': steps,
+        'backend': fake.stats(),
+        'metrics': utilities.metrics.summary(),
+        }, indent=2))
+    exit(0)
+
+role_name = 'WexCloudFormationCrossAccountRole'
+
+started = monotonic()
+invocations = 0
+with utilities.metrics.invocation('CFNAutoAssociate'):
+    if args.share:
+        invocations += run({
+            'RequestType': 'Create',
+            'ResourceProperties': {
+                'Principals': principals,
+                'RoleName': role_name,
+                'ShareArn': list(fake.shares)[0],
+                'VpcDni': list(),
+                },
+            })
+
+    # one custom resource per principal
+    for principal in principals if not args.share else list():
+        invocations += run({
+            'RequestType': 'Create',
+            'ResourceProperties': {
+                'RoleARN': f'arn:aws:iam::{principal}:role/{role_name}',
+                'ShareArn': list(fake.shares)[0],
+                'VpcDni': list(),
+                },
+            })
+
+print(json.dumps({
+    'seconds': monotonic() - started,
+    'invocations': invocations,
+    'associations': sum([
+        len(fake.accounts[principal].associations)
+        for principal
+        in principals
+        ]),
+    'backend': fake.stats(),
+    'metrics': utilities.metrics.summary(),
+    }, indent=2))
@@ -1,17 +1,42 @@
 #!/usr/bin/env python3
+import argparse
 import json
 import sys
 
 sys.path.insert(1, '.')
 sys.path.insert(1, './python')
 
-from python import CFNZonesTransform
+from python import CFNZonesTransform  # noqa: E402
+from FakeAws import FakeAws  # noqa: E402
 
-with open('test/CFNZonesTransform_awszones_test.json') as f:
+parser = argparse.ArgumentParser()
+parser.add_argument("-e", "--event", type=str,
+                    help="CFN macro event",
+                    default="test/CFNZonesTransform_awszones_test.json")
+parser.add_argument("--aws", action='store_true',
+                    help="Use real AWS instead of the fake backend",
+                    default=False)
+parser.add_argument("--latency", type=float,
+                    help="Fake backend: seconds per API call",
+                    default=0.0)
+parser.add_argument("--throttle-rate", type=float,
+                    help="Fake backend: ThrottlingException probability",
+                    default=0.0)
+args = parser.parse_args()
+
+with open(args.event) as f:
     data = json.load(f)
 
 data['templateParameterValues']['LocalTest'] = True
 
+if not args.aws:
+    FakeAws(account_id=data['accountId'],
+            region=data['region'],
+            lob=data['templateParameterValues']['Lob'],
+            environment=data['templateParameterValues']['Environment'],
+            latency=args.latency,
+            throttle_rate=args.throttle_rate).install()
+
 response = CFNZonesTransform.create_template(data, None)
 
-print(json.dumps(response))
+print(json.dumps(response, default=str))
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+'''
+Scale benchmark for CFNZonesTransform.create_template against FakeAws.
+
+    ./test/CFNZonesTransform_bench.py --save     # record a local baseline
+    ./test/CFNZonesTransform_bench.py --compare  # fail on regressions
+'''
+import argparse
+import json
+import sys
+import tracemalloc
+
+from copy import deepcopy
+from time import perf_counter
+
+sys.path.insert(1, '.')
+sys.path.insert(1, './python')
+
+from python import CFNZonesTransform  # noqa: E402
+from FakeAws import FakeAws  # noqa: E402
+
+import utilities  # noqa: E402
+
+# (kind, zones, principals, exported VPCs)
+scenarios = [
+        ('AwsZones', 100, 10, 1),
+        ('AwsZones', 1000, 10, 1),
+        ('AwsZones', 5000, 10, 1),
+        ('AwsZones', 20000, 10, 1),
+        ('AwsZones', 1000, 100, 1),
+        ('AwsZones', 1000, 1000, 1),
+        ('OnPremZones', 100, 10, 1),
+        ('OnPremZones', 100, 10, 10),
+        ('OnPremZones', 100, 10, 200),
+        ('OnPremZones', 1000, 10, 10),
+        ]
+
+# quick subset for local iterations
+quick = [
+        ('AwsZones', 100, 10, 1),
+        ('AwsZones', 1000, 100, 1),
+        ('OnPremZones', 100, 10, 10),
+        ]
+
+owner = '229349022034'
+
+# measured values compared against the baseline, and the absolute slack
+# on top of the relative tolerance (timings of tiny scenarios are noise)
+checked = {
+        'seconds': 0.05,
+        'peak_bytes': 0,
+        'resources': 0,
+        'fragment_bytes': 0,
+        }
+
+
+def scenario_name(scenario):
+    return '{}-z{}-p{}-v{}'.format(*scenario)
+
+
+def mk_event(kind, zones, principals, max_rules):
+    with open('test/CFNZonesTransform_awszones_test.json') as f:
+        event = json.load(f)
+
+    wex = event['fragment']['Mappings']['Wex']
+    for k in ['AwsZones', 'OnPremZones']:
+        wex.pop(k, None)
+
+    wex[kind] = zones
+    wex['Accounts'] = [owner] + principals
+    wex['Infoblox']['Regions']['default']['VpcDni'] = list()
+    wex['Infoblox']['Regions']['us-east-1']['OnPremResolverIps'] = [
+            '10.94.1.77',
+            '10.232.4.1',
+            ]
+
+    event['accountId'] = owner
+    event['templateParameterValues']['LocalTest'] = True
+    event['templateParameterValues']['Instantiate'] = kind
+    event['templateParameterValues']['MaxRulesPerShare'] = f'{max_rules}'
+
+    return event
+
+
+def run(scenario, args):
+    kind, zone_count, principal_count, vpc_count = scenario
+
+    zones = [
+            f'zone{i:06d}.bench.example.'
+            for i
+            in range(zone_count)
+            ]
+    principals = [
+            f'{100000000000 + i:012d}'
+            for i
+            in range(principal_count)
+            ]
+
+    event = mk_event(kind, zones, principals, args.max_rules)
+    parameters = event['templateParameterValues']
+
+    # part of the zones already exists and is shared to all principals;
+    # keeps the reconciliation paths busy as well
+    existing = zones[:int(zone_count * args.existing)]
+
+    fake = FakeAws(account_id=owner,
+                   region=event['region'],
+                   lob=parameters['Lob'],
+                   environment=parameters['Environment'],
+                   share_prefix=f'wex-{kind}-zones-share-'
+                   f'{parameters["TargetEnvironment"]}'.lower(),
+                   vpcs=vpc_count,
+                   zones=existing,
+                   shares=(len(existing) + args.max_rules - 1)
+                   // args.max_rules,
+                   max_rules=args.max_rules).install()
+
+    try:
+        tracemalloc.start()
+        started = perf_counter()
+
+        response = CFNZonesTransform.create_template(deepcopy(event), None)
+
+        seconds = perf_counter() - started
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    finally:
+        fake.uninstall()
+
+    if response['status'] != 'SUCCESS':
+        raise RuntimeError(f'{scenario_name(scenario)}: {response}')
+
+    resources = response['fragment']['Resources']
+
+    return {
+            'seconds': seconds,
+            'peak_bytes': peak_bytes,
+            'resources': len(resources),
+            'fragment_bytes': len(json.dumps(response['fragment'],
+                                             default=str)),
+            }
+
+
+def compare(results, baseline, tolerance):
+    regressions = list()
+
+    for name, value in results.items():
+        if name not in baseline:
+            continue
+        for key, slack in checked.items():
+            old, new = baseline[name][key], value[key]
+            if new > old * (1 + tolerance) + slack:
+                regressions.append(f'{name}: {key} {old} -> {new}')
+
+    return regressions
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-b", "--baseline", type=str,
+                    help="Baseline file",
+                    default="test/CFNZonesTransform_bench.json")
+parser.add_argument("-s", "--save", action='store_true',
+                    help="Save results as the new baseline",
+                    default=False)
+parser.add_argument("-c", "--compare", action='store_true',
+                    help="Exit non-zero on regressions against the baseline",
+                    default=False)
+parser.add_argument("-t", "--tolerance", type=float,
+                    help="Allowed relative regression", default=0.25)
+parser.add_argument("-q", "--quick", action='store_true',
+                    help="Run the quick subset only", default=False)
+parser.add_argument("-m", "--max-rules", type=int,
+                    help="MaxRulesPerShare", default=50)
+parser.add_argument("-e", "--existing", type=float,
+                    help="Share of the zones that already exists",
+                    default=0.5)
+args = parser.parse_args()
+
+# keep the per-invocation metrics quiet
+utilities.metrics.sink = lambda line: None
+
+results = dict()
+for scenario in quick if args.quick else scenarios:
+    results[scenario_name(scenario)] = run(scenario, args)
+    print(json.dumps({scenario_name(scenario):
+                      results[scenario_name(scenario)]}), flush=True)
+
+if args.save:
+    try:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        baseline = dict()
+
+    baseline.update(results)
+
+    with open(args.baseline, 'w') as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+
+if args.compare:
+    try:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        print(f'No baseline in {args.baseline}, record one with --save'
+              f' (timings are machine specific, none is committed)',
+              file=sys.stderr)
+        exit(1)
+
+    regressions = compare(results, baseline, args.tolerance)
+
+    for regression in regressions:
+        print(f'REGRESSION {regression}', file=sys.stderr)
+
+    if regressions:
+        exit(1)
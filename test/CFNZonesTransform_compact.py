@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+'''
+compact_fragment against FakeAws, StackLevelTags off: the fragment never
+grows and gets smaller from a few dozen zones, and expanding the WexCompact
+lookups gives back the fragment as it was before the compaction.
+
+    ./test/CFNZonesTransform_compact.py
+'''
+import json
+import sys
+
+from copy import deepcopy
+
+sys.path.insert(1, '.')
+sys.path.insert(1, './python')
+
+from python import CFNZonesTransform  # noqa: E402
+from FakeAws import FakeAws  # noqa: E402
+
+import utilities  # noqa: E402
+
+compact_fragment = CFNZonesTransform.compact_fragment
+uncompacted = list()
+
+
+def keep_uncompacted(parm, fragment):
+    uncompacted.append(deepcopy(fragment))
+    return compact_fragment(parm, fragment)
+
+
+def expand(value, mapping):
+    if isinstance(value, dict):
+        lookup = value.get('Fn::FindInMap')
+        if lookup is not None and \
+                lookup[0] == CFNZonesTransform.compact_mapping:
+            return mapping[lookup[1]][lookup[2]]
+        return dict([
+            (key, expand(item, mapping))
+            for key, item
+            in value.items()
+            ])
+    if isinstance(value, list):
+        return [expand(item, mapping) for item in value]
+    return value
+
+
+def check(filename, mode, vpc_count, principal_count, zone_count):
+    with open(filename) as f:
+        event = json.load(f)
+
+    parameters = event['templateParameterValues']
+    parameters['LocalTest'] = True
+    parameters['VpcAssociationMode'] = mode
+    wex = event['fragment']['Mappings']['Wex']
+    wex[parameters['Instantiate']] += [
+            f'zone{i:04d}.compact.example.'
+            for i
+            in range(zone_count - len(wex[parameters['Instantiate']]))
+            ]
+    wex['Accounts'] += [
+            f'{100000000000 + i:012d}'
+            for i
+            in range(principal_count)
+            ]
+
+    fake = FakeAws(account_id=event['accountId'],
+                   region=event['region'],
+                   lob=parameters['Lob'],
+                   environment=parameters['Environment'],
+                   vpcs=vpc_count).install()
+    try:
+        uncompacted.clear()
+        response = CFNZonesTransform.create_template(event, None)
+    finally:
+        fake.uninstall()
+    assert response['status'] == 'SUCCESS', response
+
+    fragment = response['fragment']
+    before = len(json.dumps(uncompacted[0], default=str))
+    after = len(json.dumps(fragment, default=str))
+    name = f'{filename} {mode} z{zone_count} v{vpc_count}' \
+        f' p{principal_count}'
+    assert after <= before, f'{name}: {before} -> {after} bytes'
+    assert after < before or zone_count < 20, f'{name}: nothing saved'
+
+    mapping = fragment['Mappings'].pop(CFNZonesTransform.compact_mapping,
+                                       dict())
+    assert expand(fragment, mapping) == uncompacted[0], f'{name}: differs'
+
+    print(f'{name}: {before} -> {after} bytes')
+
+
+CFNZonesTransform.compact_fragment = keep_uncompacted
+utilities.metrics.sink = lambda line: None
+
+for filename, zone_count in [
+        ('test/CFNZonesTransform_awszones_test.json', 111),
+        ('test/CFNZonesTransform_onprem_test.json', 8),
+        ('test/CFNZonesTransform_onprem_test.json', 50),
+        ]:
+    for mode in ['Resource', 'Bulk']:
+        for vpc_count, principal_count in [(1, 0), (3, 10)]:
+            check(filename, mode, vpc_count, principal_count, zone_count)
+
+print('OK')
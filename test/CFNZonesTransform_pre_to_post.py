@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+'''
+Property check: CFNZonesTransform.pre_to_post against the original
+(sort-and-scan) implementation on random slot layouts.
+
+    ./test/CFNZonesTransform_pre_to_post.py [cases] [seed]
+'''
+import random
+import sys
+
+from copy import deepcopy
+
+sys.path.insert(1, '.')
+sys.path.insert(1, './python')
+
+from python import CFNZonesTransform  # noqa: E402
+
+
+def reference(pre, new_objs, max_objs):
+    post = dict(
+            [
+                (
+                    int(number),
+                    list()
+                    )
+                for number
+                in pre
+                ]
+            )
+
+    for idx in pre:
+        new_idx = int(idx)  # use `idx` as-is, make `new_idx` int
+        for old_obj in sorted(pre[idx]):
+            if old_obj in new_objs and \
+                    len(post[new_idx]) < int(max_objs):
+                post[new_idx].append(old_obj)
+                new_objs.remove(old_obj)
+
+    serial = 0  # start scanning from zero
+    while True:
+        for new_obj in sorted(new_objs):
+            for idx in sorted(post):
+                if len(post[idx]) < int(max_objs):
+                    post[idx].append(new_obj)
+                    new_objs.remove(new_obj)
+                    break
+
+        if not new_objs:
+            break
+
+        while serial in post:
+            serial += 1
+
+        post[serial] = list()
+
+    return post
+
+
+def random_case(rnd):
+    max_objs = rnd.randint(1, 8)
+    universe = [f'zone{i:03d}.example.' for i in range(rnd.randint(0, 60))]
+
+    # existing slots: sparse numbers, possibly over capacity, string keys
+    # (as they come from JSON) and objects that are gone by now
+    pre = dict()
+    for number in rnd.sample(range(12), rnd.randint(0, 8)):
+        key = f'{number}' if rnd.random() < 0.3 else number
+        pre[key] = rnd.sample(universe, min(len(universe),
+                                            rnd.randint(0, max_objs + 2)))
+
+    new_objs = set(rnd.sample(universe, rnd.randint(0, len(universe))))
+
+    # principals are passed as a list
+    if rnd.random() < 0.5:
+        new_objs = sorted(new_objs)
+
+    return pre, new_objs, f'{max_objs}' if rnd.random() < 0.5 else max_objs
+
+
+cases = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+rnd = random.Random(int(sys.argv[2]) if len(sys.argv) > 2 else 0)
+
+for case in range(cases):
+    pre, new_objs, max_objs = random_case(rnd)
+
+    expected_objs, actual_objs = deepcopy(new_objs), deepcopy(new_objs)
+    expected = reference(deepcopy(pre), expected_objs, max_objs)
+    actual = CFNZonesTransform.pre_to_post(deepcopy(pre), actual_objs,
+                                           max_objs)
+
+    # same slots, same order of slots and objects, `new_objs` consumed
+    assert list(expected.items()) == list(actual.items()), \
+        f'case {case}: {pre} {new_objs} {max_objs}:' \
+        f' {expected} != {actual}'
+    assert expected_objs == actual_objs, f'case {case}: {actual_objs}'
+
+print(f'{cases} cases OK')
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+'''
+Switches VpcAssociationMode back and forth while zones are added, applying
+every template to FakeAws the way CloudFormation would. Each (VPC, zone)
+pair must stay associated, owned by exactly one resource, and never change
+its owner (a change means a delete or a duplicate association).
+
+    ./test/CFNZonesTransform_vpc_modes.py
+'''
+import json
+import sys
+
+from copy import deepcopy
+
+sys.path.insert(1, '.')
+sys.path.insert(1, './python')
+
+from python import CFNZonesTransform  # noqa: E402
+from FakeAws import FakeAws  # noqa: E402
+
+import utilities  # noqa: E402
+
+with open('test/CFNZonesTransform_onprem_test.json') as f:
+    base = json.load(f)
+
+owner = base['accountId']
+vpc_count = 3
+zones = base['fragment']['Mappings']['Wex']['OnPremZones']
+
+fake = FakeAws(account_id=owner,
+               region=base['region'],
+               lob=base['templateParameterValues']['Lob'],
+               environment=base['templateParameterValues']['Environment'],
+               vpcs=vpc_count).install()
+associations = fake.accounts[owner].associations
+
+
+def rule_ids():
+    return dict([
+        (rule['DomainName'], rule['Id'])
+        for rule
+        in fake.accounts[owner].rules.values()
+        ])
+
+
+def deploy(mode, zone_count):
+    event = deepcopy(base)
+    event['templateParameterValues']['LocalTest'] = True
+    event['templateParameterValues']['VpcAssociationMode'] = mode
+    event['fragment']['Mappings']['Wex']['OnPremZones'] = zones[:zone_count]
+
+    response = CFNZonesTransform.create_template(event, None)
+    assert response['status'] == 'SUCCESS', response
+    resources = response['fragment']['Resources']
+
+    # CloudFormation creates the rules, then the associations
+    for zone in CFNZonesTransform.clean_zone_names(zones[:zone_count]):
+        if zone not in rule_ids():
+            fake.create_rule(owner, zone)
+
+    def domain(logical_id):
+        return resources[logical_id]['Properties']['DomainName']
+
+    pairs = dict()  # (vpc, zone) -> association names
+    for logical_id, resource in resources.items():
+        properties = resource.get('Properties', dict())
+        if resource['Type'] == 'AWS::Route53Resolver::ResolverRuleAssociation':
+            zone = domain(properties['ResolverRuleId']['Fn::GetAtt'][0])
+            pairs.setdefault((properties['VPCId'], zone), list()).append(None)
+        elif 'RuleIds' in properties:
+            rules = [rule['Fn::GetAtt'][0] for rule in properties['RuleIds']]
+            assert rules == sorted(rules), f'unstable RuleIds: {rules}'
+            for rule in rules:
+                pair = (properties['VpcId'], domain(rule))
+                pairs.setdefault(pair, list()).append(
+                        utilities.auto_association_name)
+
+    ids = rule_ids()
+    for (vpc, zone), names in pairs.items():
+        assert len(names) == 1, f'{mode}: {vpc}/{zone} owned {len(names)}x'
+        existing = associations.get((vpc, ids[zone]), names[0])
+        assert existing == names[0], f'{mode}: {vpc}/{zone} changes owner'
+        associations[(vpc, ids[zone])] = names[0]
+
+    expected = vpc_count * zone_count
+    assert len(pairs) == expected, f'{mode}: {len(pairs)}/{expected} pairs'
+
+    return sum([name is None for name in associations.values()])
+
+
+steps = [('Resource', 3), ('Bulk', 5), ('Resource', 7), ('Bulk', 8)]
+for mode, zone_count in steps:
+    resource_owned = deploy(mode, zone_count)
+    print(f'{mode} {zone_count} zones: {len(associations)} associations,'
+          f' {resource_owned} by resources')
+
+fake.uninstall()
+print('OK')
@@ -0,0 +1,441 @@
+#!/usr/bin/env python3
+'''
+In-process stand-in for the AWS calls in `utilities.boto3_map` (plus STS
+and asynchronous Lambda invocations),
+good enough to run the transforms and CFNAutoAssociate without accounts:
+
+    fake = FakeAws(zones=zones, principals=accounts, latency=0.05)
+    fake.install()  # replaces utilities.boto3_client
+    ...
+    fake.uninstall()
+'''
+import json
+import random
+import re
+import sys
+import threading
+
+from argparse import Namespace
+from botocore.exceptions import ClientError
+from datetime import datetime, timedelta, timezone
+from time import sleep
+
+sys.path.insert(1, '.')
+sys.path.insert(1, './python')
+
+import utilities  # noqa: E402
+
+# page sizes used when the request has no MaxResults
+page_size = {
+        'cloudformation': 100,
+        'route53resolver': 10,
+        'ram': 50,
+        }
+
+
+class FakeAws:
+    def __init__(self,
+                 account_id='229349022034',
+                 region='us-east-1',
+                 lob='custodian',
+                 environment='prod',
+                 share_prefix='wex-awszones-zones-share-devtest',
+                 exports=0,
+                 vpcs=1,
+                 remote_vpcs=1,
+                 zones=list(),
+                 shares=0,
+                 max_rules=50,
+                 principals=list(),
+                 latency=0.0,
+                 throttle_rate=0.0,
+                 seed=0):
+        '''
+        `exports`: extra (unrelated) exports in every account
+        `vpcs`/`remote_vpcs`: exported VPCs in the owner/principal accounts
+        `zones`, `shares`, `max_rules`: existing rules, spread over shares
+        `principals`: accounts the existing shares are shared with
+        `latency`: seconds per call, or {method: seconds}
+        `throttle_rate`: probability of a ThrottlingException per call of
+            `utilities.boto3_map` (the other calls rely on botocore retries)
+        '''
+        self.account_id = account_id
+        self.region = region
+        self.short_region = re.sub('(.).*?-', '\\1', region)
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = dict()
+        self.throttled = dict()
+        self.installed = None
+        self.invocations = list()  # asynchronous Lambda invocations
+
+        prefix = f'{lob}-{environment}-{self.short_region}'
+
+        self.accounts = dict()
+        for account in [account_id] + list(principals):
+            owner = account == account_id
+            self.accounts[account] = Namespace(
+                    exports=[
+                        {
+                            'ExportingStackId': f'arn:aws:cloudformation:'
+                            f'{region}:{account}:stack/filler/{i}',
+                            'Name': f'{prefix}-filler{i:05d}-stk-Value',
+                            'Value': f'filler-{i:05d}',
+                            }
+                        for i
+                        in range(exports)
+                        ] + [
+                        {
+                            'ExportingStackId': f'arn:aws:cloudformation:'
+                            f'{region}:{account}:stack/vpc/{i}',
+                            'Name': f'{prefix}-vpc{i:03d}-stk-Vpc-Id',
+                            'Value': f'vpc-{account}{i:05d}',
+                            }
+                        for i
+                        in range(vpcs if owner else remote_vpcs)
+                        ],
+                    rules=dict(),
+                    associations=dict(),  # (vpc, rule) -> Name
+                    )
+
+        owner = self.accounts[account_id]
+        owner.exports += [
+                {
+                    'ExportingStackId': f'arn:aws:cloudformation:'
+                    f'{region}:{account_id}:stack/endpoints/0',
+                    'Name': f'{prefix}-cfn-endpoints-stk-'
+                    f'route53-{direction}-endpoint-id',
+                    'Value': f'rslvr-{direction[:-5]}-{account_id}',
+                    }
+                for direction
+                in ['inbound', 'outbound']
+                ]
+        for i in range(3):
+            owner.exports.append({
+                'ExportingStackId': f'arn:aws:cloudformation:'
+                f'{region}:{account_id}:stack/vpc/0',
+                'Name': f'{prefix}-vpc-stk-PrivateSubnet{i + 1}-Id',
+                'Value': f'subnet-{account_id}{i:05d}',
+                })
+
+        self.endpoint_ips = [
+                {
+                    'IpId': f'rni-{i:017d}',
+                    'Ip': f'10.0.{i}.2',
+                    'SubnetId': f'subnet-{account_id}{i:05d}',
+                    'Status': 'ATTACHED',
+                    }
+                for i
+                in range(2)
+                ]
+
+        # existing rules and their RAM shares
+        self.shares = dict()
+        for zone in zones:
+            self.create_rule(account_id, zone)
+
+        rules = sorted(owner.rules.values(), key=lambda x: x['DomainName'])
+        for zone_slot in range(shares):
+            chunk = rules[zone_slot * max_rules:(zone_slot + 1) * max_rules]
+            if not chunk:
+                break
+            arn = f'arn:aws:ram:{region}:{account_id}:resource-share/' \
+                f'{zone_slot:08x}'
+            self.shares[arn] = Namespace(
+                    name=f'{share_prefix}-{0:04x}{zone_slot:04x}',
+                    status='ACTIVE',
+                    resources=[rule['Arn'] for rule in chunk],
+                    principals=list(principals),
+                    tags=list(),
+                    )
+
+    def install(self):
+        self.installed = utilities.boto3_client
+        utilities.boto3_client = self.client
+        utilities.invalidate_cache()
+        return self
+
+    def uninstall(self):
+        if self.installed is not None:
+            utilities.boto3_client = self.installed
+            self.installed = None
+        utilities.invalidate_cache()
+
+    def client(self, service, access_token=dict()):
+        account = self.account_id
+        m = re.match('^FAKE(\\d{12})$',
+                     access_token.get('aws_access_key_id', ''))
+        if m:
+            account = m.group(1)
+        return FakeClient(self, service, account)
+
+    def stats(self):
+        with self.lock:
+            return {
+                    'calls': dict(self.calls),
+                    'throttled': dict(self.throttled),
+                    }
+
+    def create_rule(self, account, zone):
+        rule_id = f'rslvr-rr-{len(self.accounts[account].rules):017x}'
+        self.accounts[account].rules[rule_id] = {
+                'Id': rule_id,
+                'Arn': f'arn:aws:route53resolver:{self.region}:{account}:'
+                f'resolver-rule/{rule_id}',
+                'DomainName': zone,
+                'Status': 'COMPLETE',
+                'RuleType': 'FORWARD',
+                'Name': re.sub('\\.', '_', zone),
+                'OwnerId': account,
+                'ShareStatus': 'NOT_SHARED',
+                }
+        return rule_id
+
+    def visible_rules(self, account):
+        '''
+        Own rules and the rules shared with `account` over RAM
+        '''
+        rules = list(self.accounts[account].rules.values())
+        if account == self.account_id:
+            return rules
+
+        shared = set()
+        for share in self.shares.values():
+            if share.status == 'ACTIVE' and account in share.principals:
+                shared.update(share.resources)
+
+        return rules + [
+                dict(rule, ShareStatus='SHARED_WITH_ME')
+                for rule
+                in self.accounts[self.account_id].rules.values()
+                if rule['Arn'] in shared
+                ]
+
+
+def resolver_filters(items, filters):
+    for f in filters:
+        items = [
+                item
+                for item
+                in items
+                if f'{item.get(f["Name"], "")}' in f['Values']
+                ]
+    return items
+
+
+class FakeClient:
+    def __init__(self, fake, service, account):
+        self.fake = fake
+        self.service = service
+        self.account = account
+
+    def __getattr__(self, method):
+        if not hasattr(FakeHandlers, method):
+            raise AttributeError(f'{self.service}.{method} is not faked')
+
+        def call(**request):
+            fake = self.fake
+
+            latency = fake.latency
+            if isinstance(latency, dict):
+                latency = latency.get(method, 0.0)
+
+            with fake.lock:
+                fake.calls[method] = fake.calls.get(method, 0) + 1
+                throttled = method in utilities.boto3_map and \
+                    fake.random.random() < fake.throttle_rate
+                if throttled:
+                    fake.throttled[method] = \
+                        fake.throttled.get(method, 0) + 1
+
+            if latency:
+                sleep(latency)
+
+            if throttled:
+                raise ClientError({
+                    'Error': {
+                        'Code': 'ThrottlingException',
+                        'Message': 'Rate exceeded',
+                        },
+                    }, method)
+
+            with fake.lock:
+                return getattr(FakeHandlers, method)(self, **request)
+
+        return call
+
+    def page(self, key, items, request, token='NextToken'):
+        size = request.get('MaxResults',
+                           request.get('maxResults',
+                                       page_size[self.service]))
+        start = int(request.get(token, 0))
+
+        response = {
+                key: items[start:start + size],
+                }
+        if start + size < len(items):
+            response[token] = f'{start + size}'
+        return response
+
+
+class FakeHandlers:
+    '''
+    Call implementations; `self` is the FakeClient, fake lock is held
+    '''
+    def assume_role(self, RoleArn, RoleSessionName):
+        account = re.sub('^arn:aws:iam::(\\d+):.*', '\\1', RoleArn)
+        if account not in self.fake.accounts:
+            raise ClientError({
+                'Error': {
+                    'Code': 'AccessDenied',
+                    'Message': f'Unknown account: {account}',
+                    },
+                }, 'assume_role')
+
+        return {
+                'Credentials': {
+                    'AccessKeyId': f'FAKE{account}',
+                    'SecretAccessKey': 'fake',
+                    'SessionToken': 'fake',
+                    'Expiration':
+                    datetime.now(timezone.utc) + timedelta(hours=1),
+                    },
+                }
+
+    def get_caller_identity(self):
+        return {
+                'Account': self.account,
+                }
+
+    def list_exports(self, **request):
+        return self.page('Exports',
+                         self.fake.accounts[self.account].exports,
+                         request)
+
+    def list_stack_resources(self, **request):
+        return self.page('StackResourceSummaries', list(), request)
+
+    def list_resolver_endpoint_ip_addresses(self, **request):
+        return self.page('IpAddresses', self.fake.endpoint_ips, request)
+
+    def list_resolver_rules(self, **request):
+        return self.page('ResolverRules',
+                         resolver_filters(
+                             self.fake.visible_rules(self.account),
+                             request.get('Filters', list())),
+                         request)
+
+    def list_resolver_rule_associations(self, **request):
+        associations = [
+                {
+                    'Id': f'rslvr-rrassoc-{vpc}-{rule_id}',
+                    'VPCId': vpc,
+                    'ResolverRuleId': rule_id,
+                    'Status': 'COMPLETE',
+                    'Name': name,
+                    }
+                for (vpc, rule_id), name
+                in sorted(self.fake.accounts[self.account]
+                          .associations.items())
+                ]
+        return self.page('ResolverRuleAssociations',
+                         resolver_filters(associations,
+                                          request.get('Filters', list())),
+                         request)
+
+    def list_tags_for_resource(self, **request):
+        return self.page('Tags', list(), request)
+
+    def associate_resolver_rule(self, VPCId, ResolverRuleId, Name=None):
+        if ResolverRuleId not in [
+                rule['Id']
+                for rule
+                in self.fake.visible_rules(self.account)
+                ]:
+            raise ClientError({
+                'Error': {
+                    'Code': 'ResourceNotFoundException',
+                    'Message': f'Resolver rule {ResolverRuleId} not found',
+                    },
+                }, 'associate_resolver_rule')
+
+        self.fake.accounts[self.account].associations[
+                (VPCId, ResolverRuleId)] = Name
+
+        return {
+                'ResolverRuleAssociation': {
+                    'VPCId': VPCId,
+                    'ResolverRuleId': ResolverRuleId,
+                    'Status': 'CREATING',
+                    },
+                }
+
+    def disassociate_resolver_rule(self, VPCId, ResolverRuleId):
+        self.fake.accounts[self.account].associations.pop(
+                (VPCId, ResolverRuleId), None)
+
+        return {
+                'ResolverRuleAssociation': {
+                    'VPCId': VPCId,
+                    'ResolverRuleId': ResolverRuleId,
+                    'Status': 'DELETING',
+                    },
+                }
+
+    def invoke(self, FunctionName, InvocationType, Payload):
+        self.fake.invocations.append(json.loads(Payload))
+        return {
+                'StatusCode': 202,
+                }
+
+    def get_resource_shares(self, **request):
+        shares = [
+                {
+                    'resourceShareArn': arn,
+                    'name': share.name,
+                    'status': share.status,
+                    'owningAccountId': self.fake.account_id,
+                    'tags': share.tags,
+                    }
+                for arn, share
+                in self.fake.shares.items()
+                if request.get('resourceShareStatus',
+                               share.status) == share.status
+                and request.get('name', share.name) == share.name
+                ]
+        return self.page('resourceShares', shares, request, 'nextToken')
+
+    def list_resources(self, **request):
+        arns = request.get('resourceShareArns', self.fake.shares.keys())
+        resources = [
+                {
+                    'arn': resource,
+                    'type': 'route53resolver:ResolverRule',
+                    'resourceShareArn': arn,
+                    'status': 'AVAILABLE',
+                    }
+                for arn
+                in arns
+                if arn in self.fake.shares
+                for resource
+                in self.fake.shares[arn].resources
+                ]
+        return self.page('resources', resources, request, 'nextToken')
+
+    def list_principals(self, **request):
+        arns = request.get('resourceShareArns', self.fake.shares.keys())
+        principals = [
+                {
+                    'id': principal,
+                    'resourceShareArn': arn,
+                    'external': False,
+                    }
+                for arn
+                in arns
+                if arn in self.fake.shares
+                for principal
+                in self.fake.shares[arn].principals
+                ]
+        return self.page('principals', principals, request, 'nextToken')
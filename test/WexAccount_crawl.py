@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+'''
+WexAccount against a fake boto3 (no AWS access, no credentials): the
+parallel crawl returns the inventory of the original serial crawl, never
+starts an item before its dependencies and keeps the per-service limits;
+the cache serves warm runs and re-crawls only stale or broken entries;
+lazy access fetches an item and its dependencies only.
+
+    ./test/WexAccount_crawl.py [seconds per call]
+'''
+import gzip
+import json
+import os
+import re
+import sys
+import tempfile
+import threading
+
+from argparse import Namespace
+from time import monotonic, sleep
+
+sys.path.insert(1, '.')
+
+import WexAccount  # noqa: E402
+
+latency = float(sys.argv[1]) if len(sys.argv) > 1 else 0.01
+
+# enabled regions of the fake account; ap-southeast-2 is not one of them
+regions = [
+        'us-east-1',
+        'us-west-2',
+        'eu-central-1',
+        'eu-west-1',
+        'ap-southeast-1',
+        'sa-east-1',
+        ]
+
+page_size = 2
+
+
+def objects(command, region, request):
+    '''
+    The whole (unpaginated) listing of the fake account
+    '''
+    if command == 'describe_regions':
+        return [{'RegionName': name} for name in regions]
+    if command == 'list_hosted_zones':
+        return [
+                {
+                    'Id': f'/hostedzone/Z{i:04d}',
+                    'Name': f'zone{i}.example.',
+                    'Config': {
+                        'PrivateZone': i % 2 == 1,
+                        },
+                    }
+                for i
+                in range(7)
+                ]
+    if command == 'describe_security_groups':
+        return [{'GroupId': f'sg-{region}-{i}'} for i in range(3)]
+    if command == 'list_resolver_endpoints':
+        return [{'Id': f'rslvr-{region}-{i}'} for i in range(2)]
+
+    return [
+            {
+                'Command': command,
+                'Region': region,
+                'Request': f'{sorted(request.items())}',
+                'Index': i,
+                }
+            for i
+            in range(3)
+            ]
+
+
+class Backend:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.calls = list()  # (command, region, request, start, end)
+            self.inflight = dict()
+            self.max_inflight = dict()
+
+    def call(self, service, region, command, request):
+        start = monotonic()
+        with self.lock:
+            self.inflight[service] = self.inflight.get(service, 0) + 1
+            self.max_inflight[service] = max(
+                    self.max_inflight.get(service, 0),
+                    self.inflight[service])
+            self.max_inflight['*'] = max(
+                    self.max_inflight.get('*', 0),
+                    sum(self.inflight.values()))
+
+        sleep(latency)
+
+        request = dict(request)
+        token = request.pop('NextToken', request.pop('Marker', 0))
+        items = objects(command, region, request)
+        start_index = int(token)
+
+        response = {
+                'Items': items[start_index:start_index + page_size],
+                'ResponseMetadata': dict(),
+                }
+        if start_index + page_size < len(items):
+            if command == 'list_hosted_zones':  # route53 style
+                response['IsTruncated'] = True
+                response['NextMarker'] = f'{start_index + page_size}'
+            else:
+                response['NextToken'] = f'{start_index + page_size}'
+        elif command == 'list_hosted_zones':
+            response['IsTruncated'] = False
+
+        with self.lock:
+            self.inflight[service] -= 1
+            self.calls.append((command, region, request, start, monotonic()))
+
+        return response
+
+
+class FakeClient:
+    def __init__(self, service, region):
+        self.service = service
+        self.region = region
+
+    def __getattr__(self, command):
+        def call(**request):
+            return backend.call(self.service, self.region, command, request)
+        return call
+
+
+class FakeSession:
+    def __init__(self, profile_name=None, region_name=None):
+        self.region_name = region_name
+
+    def client(self, service):
+        return FakeClient(service, self.region_name)
+
+
+def reference():
+    '''
+    Inventory as the original serial crawl built it
+    '''
+    def items(name, region, **request):
+        return objects(WexAccount.aws[name]['command'], region, request)
+
+    data = dict([(name, dict()) for name in WexAccount.aws])
+
+    for name in WexAccount.aws:
+        if 'global' in WexAccount.aws[name]:
+            if name not in WexAccount.aws_per_object:
+                data[name] = items(name, 'us-east-1')
+                continue
+
+            parameter = WexAccount.aws_per_object[name][2]
+            for zone in items('hosted-zones', 'us-east-1'):
+                if zone['Config']['PrivateZone']:
+                    zone_id = re.sub('.*/', '', zone['Id'])
+                    data[name][zone_id] = items(
+                            name, 'us-east-1', **{parameter: zone_id})
+            continue
+
+        for region in WexAccount.aws_region_limit.intersection(regions):
+            if region in WexAccount.aws[name].get('skip-regions', list()):
+                continue
+
+            if name not in WexAccount.aws_per_object:
+                data[name][region] = items(name, region)
+                continue
+
+            src, key, parameter, as_list = WexAccount.aws_per_object[name]
+            data[name][region] = dict([
+                (
+                    obj[key],
+                    items(name, region, **{
+                        parameter: [obj[key]] if as_list else obj[key],
+                        }),
+                    )
+                for obj
+                in items(src, region)
+                ])
+
+    return data
+
+
+def units_of(command, region):
+    '''
+    (item, region) of a call; region is None for global items
+    '''
+    for name, item in WexAccount.aws.items():
+        if item['command'] == command:
+            return (name, None if 'global' in item else region)
+
+
+def check_order(account, calls):
+    '''
+    No call starts before every call of the units it depends on ended
+    '''
+    units = account.crawl_units()
+    ended = dict()
+    for command, region, _, _, end in calls:
+        unit = units_of(command, region)
+        ended[unit] = max(ended.get(unit, 0), end)
+
+    for command, region, _, start, _ in calls:
+        for dep in units[units_of(command, region)]:
+            assert dep in ended, f'{command}/{region}: {dep} never fetched'
+            assert start >= ended[dep], f'{command}/{region} before {dep}'
+
+
+def rewrite_cache(account, name, region, change):
+    path = account.cache_path(name, region)
+    with open(path, 'rb') as f:
+        entry = json.loads(gzip.decompress(f.read()))
+    with open(path, 'wb') as f:
+        f.write(change(entry))
+
+
+def mk_account(name):
+    return WexAccount.WexAccount(Namespace(logging='ERROR'), name)
+
+
+WexAccount.boto3.Session = FakeSession
+tempfile.tempdir = tempfile.mkdtemp()  # cache of this run only
+backend = Backend()
+expected = reference()
+
+# cold: everything crawled, in dependency order, within the limits
+started = monotonic()
+account = mk_account('wex').retrieve_all()
+seconds = monotonic() - started
+
+assert dict(account.data) == expected, 'inventory differs'
+check_order(account, backend.calls)
+for service, limit in WexAccount.crawl_service_limits.items():
+    assert backend.max_inflight.get(service, 0) <= limit, \
+        f'{service}: {backend.max_inflight[service]} calls in flight'
+
+serial = len(backend.calls) * latency
+print(f'cold: {len(backend.calls)} calls in {seconds:.2f}s'
+      f' (serial {serial:.2f}s), in flight {backend.max_inflight}')
+
+# warm: served from the cache, no calls
+backend.reset()
+started = monotonic()
+account = mk_account('wex').retrieve_all()
+assert dict(account.data) == expected, 'cached inventory differs'
+assert not backend.calls, f'warm run made {len(backend.calls)} calls'
+print(f'warm: {(monotonic() - started) * 1000:.1f}ms')
+
+
+def expire(entry):
+    entry['Created'] -= WexAccount.cache_ttl + 1
+    return gzip.compress(json.dumps(entry).encode())
+
+
+def truncate(entry):
+    return gzip.compress(json.dumps(entry).encode())[:40]
+
+
+def other_version(entry):
+    entry['Version'] = WexAccount.cache_version + 1
+    return gzip.compress(json.dumps(entry).encode())
+
+
+# stale or broken (item, region) entries: that unit only is crawled again
+for change, name, region in [
+        (expire, 'security-group-references', 'eu-west-1'),
+        (truncate, 'vpcs', 'us-east-1'),
+        (other_version, 'hosted-zone-associations', None),
+        ]:
+    rewrite_cache(account, name, region, change)
+
+    backend.reset()
+    account = mk_account('wex').retrieve_all()
+    assert dict(account.data) == expected, f'{change.__name__}: differs'
+
+    refetched = set([
+        units_of(command, call_region)
+        for command, call_region, _, _, _
+        in backend.calls
+        ])
+    assert refetched == set([(name, region)]), \
+        f'{change.__name__}: {refetched}'
+    print(f'{change.__name__} {name}/{region}: {len(backend.calls)} calls')
+
+leftovers = [
+        filename
+        for _, _, filenames
+        in os.walk(tempfile.tempdir)
+        for filename
+        in filenames
+        if filename.endswith('.tmp')
+        ]
+assert not leftovers, f'partial writes: {leftovers}'
+
+# lazy: nothing on init, then each item with its dependencies only
+tempfile.tempdir = tempfile.mkdtemp()
+backend.reset()
+account = mk_account('wex')
+assert not backend.calls, f'__init__ made {len(backend.calls)} calls'
+assert 'vpcs' in account.data and 'nope' not in account.data
+assert not backend.calls, 'membership tests made calls'
+
+for name, fetched in [
+        ('hosted-zones', set(['hosted-zones'])),
+        ('resolver-endpoint-ip-addresses', set([
+            'regions',
+            'resolver-endpoints',
+            'resolver-endpoint-ip-addresses',
+            ])),
+        ('hosted-zones', set()),  # loaded already
+        ]:
+    backend.reset()
+    assert account.data[name] == expected[name], f'lazy {name} differs'
+
+    names = set([
+        units_of(command, region)[0]
+        for command, region, _, _, _
+        in backend.calls
+        ])
+    assert names == fetched, f'lazy {name}: fetched {names}'
+    print(f'lazy {name}: {len(backend.calls)} calls')
+
+assert dict(account.data) == expected, 'lazy inventory differs'
+
+print('OK')